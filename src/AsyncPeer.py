@@ -0,0 +1,70 @@
+import asyncio
+
+from src.AsyncStream import AsyncStream
+from src.Peer import Peer
+
+"""
+    AsyncPeer is the asyncio runtime of our Peer.
+    Packet handling, the reunion daemon and the user interface are coroutines on a single event loop instead of
+    separate threads, so many peers can share one process.
+
+"""
+
+
+class AsyncPeer(Peer):
+    REUNION_INTERVAL = 0.1
+    USER_INTERFACE_INTERVAL = 0.1
+
+    def new_stream(self, server_ip, server_port):
+        """
+
+        :return: The AsyncStream our Peer communicates through.
+        :rtype: AsyncStream
+        """
+        return AsyncStream(server_ip, server_port)
+
+    def run(self):
+        """
+        Runs the Peer on a new event loop until it is stopped.
+
+        :return:
+        """
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        """
+        The main coroutine of the Peer; use it instead of 'run' to share an event loop with other peers.
+
+        :return:
+        """
+        await self.stream.start()
+        await asyncio.gather(self.__handle_stream(), self.__run_reunion_daemon(),
+                             self.__handle_user_interface_buffer())
+
+    async def __handle_stream(self):
+        while True:
+            self.handle_stream()
+            await self.stream.wait_for_activity()
+            if self.flush_delay > 0:
+                await self.stream.wait_for_flush(self.flush_delay)
+
+    async def __run_reunion_daemon(self):
+        if self.is_root:
+            expiry_changed = asyncio.Event()
+            self.network_graph.expiry_listener = expiry_changed.set
+            while True:
+                expiry_changed.clear()
+                timeout = self.network_graph.remove_all_expired_nodes()
+                try:
+                    await asyncio.wait_for(expiry_changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        else:
+            while True:
+                self.handle_reunion(AsyncPeer.REUNION_INTERVAL)
+                await asyncio.sleep(AsyncPeer.REUNION_INTERVAL)
+
+    async def __handle_user_interface_buffer(self):
+        while True:
+            self.parse_user_interface_buffer()
+            await asyncio.sleep(AsyncPeer.USER_INTERFACE_INTERVAL)
@@ -0,0 +1,137 @@
+import asyncio
+import socket
+
+from src.Stream import Stream
+from src.tools.AsyncNode import AsyncNode
+
+
+class AsyncStream(Stream):
+
+    def __init__(self, ip, port, send_acks=False, backlog=socket.SOMAXCONN, receive_bytes=None):
+        """
+        The AsyncStream object constructor.
+
+        Same interface and wire format as Stream, but the server is an asyncio.start_server on the caller's event
+        loop instead of a TCPServer thread, and every Node is an AsyncNode. Nothing happens on the network before
+        'start' is awaited.
+
+        :param ip: 15 characters
+        :param port: 5 characters
+        :param send_acks: Answer every read with a cumulative acknowledgement.
+        :param backlog: Accept backlog of our server.
+        :param receive_bytes: Maximum number of bytes read from a connection at once; None means
+                              Stream.receive_bytes.
+        """
+        self.server = None
+        self.activity = None
+        # Nodes whose transport we are waiting to drain.
+        self._draining = set()
+        if receive_bytes is not None:
+            self.receive_bytes = receive_bytes
+        Stream.__init__(self, ip, port, send_acks=send_acks, backlog=backlog)
+
+    def start_server(self, backlog):
+        """
+        The server is started on the event loop by 'start'.
+
+        :param backlog: Accept backlog of our server.
+
+        :return:
+        """
+        self.backlog = backlog
+
+    async def start(self):
+        """
+        Starts our server and opens the connections of the nodes added so far.
+
+        :return:
+        """
+        self.activity = asyncio.Event()
+        self._flush_due = asyncio.Event()
+        self.server = await asyncio.start_server(self.__handle_connection, self.ip, self.port, backlog=self.backlog)
+        for node in self.nodes:
+            self.__open(node)
+
+    def watch_writable(self, node, watch):
+        """
+        Asyncio transports write the rest as soon as their socket is writable; A node whose transport is too full to
+        take more only needs a wakeup when it has drained.
+
+        :return:
+        """
+        if not watch or node in self._draining or node.writer is None:
+            return
+
+        async def drain_and_flush():
+            await node.drain()
+            self._draining.discard(node)
+            self.wakeup()
+
+        self._draining.add(node)
+        asyncio.ensure_future(drain_and_flush())
+
+    def wakeup(self):
+        """
+        Interrupts 'wait_for_activity'; Only call it from our event loop.
+
+        :return:
+        """
+        if self.activity is not None:
+            self.activity.set()
+
+    async def wait_for_activity(self):
+        """
+        Waits until a frame arrives or a message is added to an out buffer.
+
+        :return:
+        """
+        await self.activity.wait()
+        self.activity.clear()
+
+    async def wait_for_flush(self, timeout):
+        """
+        Waits until Stream.flush_bytes or Stream.flush_packets are received or queued since our last flush, or for at
+        most 'timeout' seconds.
+
+        :param timeout: Maximum seconds to wait.
+
+        :return:
+        """
+        try:
+            await asyncio.wait_for(self._flush_due.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def __handle_connection(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        try:
+            while True:
+                data = await reader.read(self.receive_bytes)
+                if not data:
+                    break
+                ack = self.receive(address, data)
+                if ack is not None:
+                    writer.write(ack)
+        except ConnectionError:
+            pass
+        finally:
+            self.forget_connection(address)
+            writer.close()
+
+    def __open(self, node):
+        async def open_and_flush():
+            await node.open()
+            self.wakeup()
+
+        asyncio.ensure_future(open_and_flush())
+
+    def new_node(self, server_address, set_register_connection):
+        """
+
+        :return: A new AsyncNode; its connection is opened as soon as our loop runs.
+        :rtype: AsyncNode
+        """
+        node = AsyncNode(server_address, set_root=False, set_register=set_register_connection)
+        if self.activity is not None:
+            self.__open(node)
+        return node
@@ -19,6 +19,8 @@
 
     Version:
         For now version is 1
+        The high byte holds flags: 0x100 means the body is zlib compressed, 0x200 and 0x400 tell that the peer with
+        the source server address accepts compressed packets and Batch frames.
     
     Type:
         1: Register
@@ -26,6 +28,8 @@
         3: Join
         4: Message
         5: Reunion
+        6: Fragment
+        7: Batch
                 e.g: type = '2' => Advertise packet.
     Length:
         This field shows the character numbers for Body of the packet.
@@ -61,9 +65,12 @@
                 |                  IP (15 Chars)                 |
                 |------------------------------------------------|
                 |                 Port (5 Chars)                 |
+                |------------------------------------------------|
+                |          Capacity (2 Chars, optional)          |
                 |________________________________________________|
                 
                 For sending IP/Port of the current node to the root to ask if it can register to network or not.
+                The node may also declare how many children it accepts; otherwise the root decides.
 
             Response:
         
@@ -96,9 +103,12 @@
                 |              Server IP (15 Chars)              |
                 |------------------------------------------------|
                 |             Server Port (5 Chars)              |
+                |------------------------------------------------|
+                |         Server Depth (3 Chars, optional)       |
                 |________________________________________________|
                 
                 Root will response Advertise Request packet with sending IP/Port of the requester peer in this packet.
+                The depth of the proposed parent lets the requester derive its reunion timeout.
                 
         Join:
 
@@ -174,42 +184,631 @@
 
                 Root in an answer to the Reunion Hello message will send this packet to the target node.
                 In this packet, all the nodes (IP, port) exist in order by path traversal to target.
+
+            Aggregated Hello:
+
+                                    ** Body Format **
+                 ________________________________________________
+                |                  AGG (3 Chars)                 |
+                |------------------------------------------------|
+                |           Number of Entries (5 Chars)          |
+                |------------------------------------------------|
+                |                 IP0 (15 Chars)                 |
+                |------------------------------------------------|
+                |                Port0 (5 Chars)                 |
+                |------------------------------------------------|
+                |                     ...                        |
+                |------------------------------------------------|
+                |                 IPN (15 Chars)                 |
+                |------------------------------------------------|
+                |                PortN (5 Chars)                 |
+                |________________________________________________|
+
+                In the aggregated reunion mode every peer sends one of these to its parent per interval instead of a
+                Reunion Hello; The entries are the peer itself and every address its children reported since its
+                previous one, in no particular order.
+
+            Aggregated Hello Back:
+
+                                    ** Body Format **
+                 ________________________________________________
+                |                  AGB (3 Chars)                 |
+                |________________________________________________|
+
+                Root answers every Aggregated Hello with one of these to the sender, and every peer that receives one
+                passes it to all of its children; It tells the whole sub-tree that its path to the root is alive.
+
+        Fragment:
+                                ** Body Format **
+                 ________________________________________________
+                |              Origin IP (15 Chars)              |
+                |------------------------------------------------|
+                |             Origin Port (5 Chars)              |
+                |------------------------------------------------|
+                |              Stream ID (10 Chars)              |
+                |------------------------------------------------|
+                |                Offset (10 Chars)               |
+                |------------------------------------------------|
+                |             Total Length (10 Chars)            |
+                |------------------------------------------------|
+                |               Data (#Length Bytes)             |
+                |________________________________________________|
+
+            A Message too large for one packet is broadcast as consecutive Fragments of one stream; The origin and its
+            stream ID name the stream, and Data is the part of the message which starts at Offset. Peers forward every
+            Fragment as soon as it arrives and only rebuild the message for their own consumer.
+
+        Batch:
+                                ** Body Format **
+                 ________________________________________________
+                |              Type0 (2 Bytes)                   |
+                |------------------------------------------------|
+                |          Length0 (Long int/4 Bytes)            |
+                |------------------------------------------------|
+                |             Body0 (#Length0 Bytes)             |
+                |------------------------------------------------|
+                |                     ...                        |
+                |________________________________________________|
+
+            Several small packets with the same Version and source server address in one frame; Every entry is one
+            packet without its header, and Length is the length of its body. Batches are only sent to peers which
+            accept them and are unpacked into packets before they are handled.
+
+
+                                            **  Version 2  **
+
+    Packets whose Version field is 2 use a compact header and binary bodies; Peers decode both versions, and every
+    packet keeps the version it was made with while it is forwarded.
+     __________________________________________________________________________________________________________________
+    |           Version(2 Bytes)         |         Type(2 Bytes)         |           Length(Long int/4 Bytes)          |
+    |------------------------------------------------------------------------------------------------------------------|
+    |                       Source Server IP(4 Bytes)                    |         Source Server Port(2 Bytes)         |
+    |------------------------------------------------------------------------------------------------------------------|
+    |                                                       BODY                                                       |
+    |__________________________________________________________________________________________________________________|
+
+    In the bodies:
+        Subtype:            1 Byte; REQ = 1, RES = 2, AGG = 3, AGB = 4.
+        IP/Port:            6 Bytes, like in the header.
+        Number of Entries:  2 Bytes.
+        Capacity:           1 Byte.
+        Server Depth:       2 Bytes.
+        Register Response:  The subtype, then "ACK" as in version 1.
+        Join:               Empty.
+        Message:            Unchanged, the UTF-8 message.
+        Fragment:           Origin (6 Bytes), then Stream ID, Offset and Total Length (4 Bytes each).
             
     
 """
-import copy
 import struct
-from array import array
-from struct import *
+import zlib
 
 from src.Type import Type
+from src.Wire import Wire
+from src.tools.FrameDecoder import FrameDecoder
 from src.tools.Node import Node
 
 
 class Packet:
+    header_size = Wire.header_size
+    _header_struct = struct.Struct(">hhihhhhi")
+    _prefix_struct = Wire.prefix_struct
+    _address_struct = struct.Struct(">hhhhi")
+    _length_struct = struct.Struct(">i")
+    subtype_size = 3
+    # Protocol version 2: the compact header and binary bodies.
+    compact_version = Wire.compact_version
+    compact_header_size = Wire.compact_header_size
+    _compact_header_struct = struct.Struct(">hhiBBBBH")
+    _compact_address_struct = struct.Struct(">BBBBH")
+    _compact_count_struct = struct.Struct(">H")
+    compact_subtypes = {"REQ": 1, "RES": 2, "AGG": 3, "AGB": 4}
+    _compact_subtype_names = {code: name for name, code in compact_subtypes.items()}
+    # Flags in the high byte of the Version field.
+    _version_mask = Wire.version_mask
+    compressed_flag = 0x100
+    accepts_compression_flag = 0x200
+    accepts_batches_flag = 0x400
+    # What the peer which put its source server address on a packet can take.
+    capability_flags = accepts_compression_flag | accepts_batches_flag
+    _version_struct = struct.Struct(">h")
+    # Stream ID, Offset and Total Length of a Fragment.
+    _compact_fragment_struct = struct.Struct(">III")
+    fragment_number_size = 10
+    # Largest capacity a Register Request carries; Version 2 puts it in one byte.
+    max_capacity = 255
 
     def __init__(self, buf=None, version=None, type=None, ip=None, port=None, body=None):
         """
             The decoded buffer should convert to a new packet.
 
+            When a buffer is given, the packet only keeps a memoryview over it; header fields and the body are
+            decoded lazily the first time a handler asks for them, so a packet that is only forwarded never pays
+            for copies or UTF-8 decoding.
+
+            Both versions of the protocol are decoded; With version 2 the header is 14 bytes and every body but the
+            one of a Message is binary.
+
+            A packet with the compressed flag keeps its buffer as it arrived, for forwarding, and its body is
+            decompressed the first time it is read.
+
         :param buf: Input buffer was just decoded.
-        :type buf: bytearray
+        :param version: Version field; The version with its flags, if any.
+        :param body: The body to encode; A str is encoded as UTF-8.
+        :type buf: bytes | bytearray | memoryview
+        :type body: str | bytes
         """
 
         if buf is None:
-            self.version, self.type, self.ip, self.port, self.body = version, type, ip, port, body
-            self.length = len(body) + 20
+            self._type, self._ip, self._port = type, ip, port
+            self._version, self._flags = version & Packet._version_mask, version & ~Packet._version_mask
+            self._body = body if isinstance(body, str) else None
+            if isinstance(body, str):
+                body = bytes(body, 'utf-8')
+            elif not isinstance(body, bytes):
+                body = bytes(body)
             parts = [int(part) for part in ip.split('.')]
-            self.buf = struct.pack(">hhihhhhi", version, int(type), self.length, parts[0], parts[1], parts[2], parts[3], port)
-            self.buf = self.buf + bytes(body, 'utf-8')
+            if self._version == Packet.compact_version:
+                self._length = len(body) + Packet.compact_header_size
+                header = Packet._compact_header_struct.pack(version, int(type), self._length, parts[0], parts[1],
+                                                            parts[2], parts[3], port)
+            else:
+                self._length = len(body) + Packet.header_size
+                header = Packet._header_struct.pack(version, int(type), self._length, parts[0], parts[1], parts[2],
+                                                    parts[3], port)
+            self.buf = header + body
+            self._plain = memoryview(self.buf)
+        else:
+            self.buf = buf
+            self._version = self._flags = self._type = self._length = None
+            self._ip = self._port = self._body = self._plain = None
+            if not self.is_compressed():
+                self._plain = memoryview(buf)
+
+    @property
+    def _view(self):
+        # The uncompressed packet.
+        if self._plain is None:
+            self.__decompress()
+        return self._plain
+
+    def __decompress(self):
+        header_size = self.get_header_size()
+        wire = memoryview(self.buf)
+        # A body is never inflated past the largest frame we would have received uncompressed.
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(wire[header_size:], FrameDecoder.max_frame_size - header_size)
+        except zlib.error as e:
+            raise ValueError("Invalid compressed body: " + str(e))
+        if decompressor.unconsumed_tail:
+            raise ValueError("Invalid compressed body: longer than " + str(FrameDecoder.max_frame_size) + " bytes")
+        if decompressor.unused_data or not decompressor.eof:
+            raise ValueError("Invalid compressed body: incomplete or followed by other data")
+        plain = bytearray(header_size + len(body))
+        plain[:header_size] = wire[:header_size]
+        plain[header_size:] = body
+        Packet._version_struct.pack_into(plain, 0, (self.version | self._flags) & ~Packet.compressed_flag)
+        Packet._length_struct.pack_into(plain, 4, len(plain))
+        self._plain = memoryview(plain)
+        self._length = len(plain)
+
+    def __decode_prefix(self):
+        # The prefix is the same in the buffer as it arrived and in the uncompressed packet, but the Length.
+        version, type, length = Packet._prefix_struct.unpack_from(self.buf, 0)
+        self._version, self._flags = version & Packet._version_mask, version & ~Packet._version_mask
+        self._type = str(type)
+        if self._length is None:
+            self._length = length if self._plain is not None or not self._flags & Packet.compressed_flag else None
+
+    def is_compressed(self):
+        """
+
+        :return: Whether the body of the packet is compressed on the wire.
+        :rtype: bool
+        """
+        if self._flags is None:
+            self.__decode_prefix()
+        return bool(self._flags & Packet.compressed_flag)
+
+    def accepts_compression(self):
+        """
+
+        :return: Whether the peer which put its source server address on the packet accepts compressed packets.
+        :rtype: bool
+        """
+        if self._flags is None:
+            self.__decode_prefix()
+        return bool(self._flags & Packet.accepts_compression_flag)
+
+    def accepts_batches(self):
+        """
+
+        :return: Whether the peer which put its source server address on the packet accepts Batch frames.
+        :rtype: bool
+        """
+        if self._flags is None:
+            self.__decode_prefix()
+        return bool(self._flags & Packet.accepts_batches_flag)
+
+    def compress(self, threshold):
+        """
+        Makes a copy of the packet with a zlib compressed body.
+
+        :param threshold: Bodies shorter than this are not compressed.
+        :type threshold: int
+
+        :return: The compressed packet; None if the body is too short or does not shrink.
+        :rtype: Packet
+        """
+        if self.is_compressed():
+            return self
+        header_size = self.get_header_size()
+        plain = self._view
+        if len(plain) - header_size < threshold or len(plain) > FrameDecoder.max_frame_size:
+            return None
+        body = zlib.compress(plain[header_size:])
+        if len(body) >= len(plain) - header_size:
+            return None
+        buf = bytearray(header_size + len(body))
+        buf[:header_size] = plain[:header_size]
+        buf[header_size:] = body
+        Packet._version_struct.pack_into(buf, 0, self.version | self._flags | Packet.compressed_flag)
+        Packet._length_struct.pack_into(buf, 4, len(buf))
+        packet = Packet(buf=buf)
+        # A copy, as in-place edits of this packet release its view.
+        packet._plain = memoryview(bytes(plain))
+        return packet
+
+    def decompressed(self):
+        """
+
+        :return: The packet with an uncompressed body; The packet itself if its body is not compressed.
+        :rtype: Packet
+        """
+        if not self.is_compressed():
+            return self
+        return Packet(buf=self._view)
+
+    def __decode_address(self):
+        if self.__is_compact():
+            self._ip, self._port = self.__unpack_address(8, buf=self.buf)
+        else:
+            self._ip, self._port = self.__unpack_address(8, Packet._address_struct, self.buf)
+
+    def __unpack_address(self, offset, address_struct=None, buf=None):
+        if address_struct is None:
+            address_struct = Packet._compact_address_struct
+        ip0, ip1, ip2, ip3, port = address_struct.unpack_from(self._view if buf is None else buf, offset)
+        return '.'.join(str(part).zfill(3) for part in (ip0, ip1, ip2, ip3)), port
+
+    def __is_compact(self):
+        return self.version == Packet.compact_version
+
+    def get_header_size(self):
+        """
+
+        :return: Header size of the packet version.
+        :rtype: int
+        """
+        return Packet.compact_header_size if self.__is_compact() else Packet.header_size
+
+    @staticmethod
+    def pack_address(address, version):
+        """
+        Encodes an (ip, port) the way bodies of the given protocol version carry it.
+
+        :param address: (ip, port)
+        :param version: Protocol version.
+
+        :return: 20 characters for version 1, 6 bytes for version 2.
+        :rtype: bytes
+        """
+        if version == Packet.compact_version:
+            parts = [int(part) for part in address[0].split('.')]
+            return Packet._compact_address_struct.pack(parts[0], parts[1], parts[2], parts[3], int(address[1]))
+        return bytes(Node.parse_ip(address[0]) + Node.parse_port(address[1]), 'utf-8')
+
+    @property
+    def version(self):
+        if self._version is None:
+            self.__decode_prefix()
+        return self._version
+
+    @property
+    def type(self):
+        if self._type is None:
+            self.__decode_prefix()
+        return self._type
+
+    @property
+    def length(self):
+        if self._length is None:
+            self.__decode_prefix()
+        if self._length is None:
+            # Length of the uncompressed packet
+            self.__decompress()
+        return self._length
+
+    @property
+    def ip(self):
+        if self._ip is None:
+            self.__decode_address()
+        return self._ip
+
+    @property
+    def port(self):
+        if self._port is None:
+            self.__decode_address()
+        return self._port
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = str(self._view[self.get_header_size():], 'utf-8')
+        return self._body
+
+    def with_source(self, source_server_address, capabilities=None):
+        """
+        Makes the same packet with a new source server address, e.g. for forwarding it.
+
+        Only the address fields are rewritten; the body is copied once into the new buffer and never decoded, and a
+        compressed body stays compressed.
+
+        :param source_server_address: The new source server address.
+        :param capabilities: The Packet.capability_flags of the new source; None keeps those of the packet.
+        :type source_server_address: tuple
+        :type capabilities: int
+
+        :return: The new packet.
+        :rtype: Packet
+        """
+        address = self.__pack_source(source_server_address)
+        wire = memoryview(self.buf)
+        if capabilities is None:
+            prefix = wire[:8]
+        else:
+            prefix = bytearray(wire[:8])
+            Packet._version_struct.pack_into(prefix, 0, self.__version_field(capabilities))
+        return Packet(buf=b''.join((prefix, address, wire[self.get_header_size():])))
+
+    def __version_field(self, capabilities):
+        if self._flags is None:
+            self.__decode_prefix()
+        return self.version | self._flags & ~Packet.capability_flags | capabilities
+
+    def __pack_source(self, source_server_address):
+        parts = [int(part) for part in source_server_address[0].split('.')]
+        if self.__is_compact():
+            return Packet._compact_address_struct.pack(parts[0], parts[1], parts[2], parts[3],
+                                                       int(source_server_address[1]))
+        return Packet._address_struct.pack(parts[0], parts[1], parts[2], parts[3], int(source_server_address[1]))
+
+    def set_source(self, source_server_address, capabilities=None):
+        """
+        Rewrites the source server address of this packet in place; A compressed packet is decompressed.
+
+        :param source_server_address: The new source server address.
+        :param capabilities: The Packet.capability_flags of the new source; None keeps those of the packet.
+        :type source_server_address: tuple
+        :type capabilities: int
+
+        :return:
+        """
+        address = self.__pack_source(source_server_address)
+        buf = self.__own_buf()
+        buf[8:8 + len(address)] = address
+        if capabilities is not None:
+            # 'buf' is never compressed.
+            version_field = self.__version_field(capabilities) & ~Packet.compressed_flag
+            Packet._version_struct.pack_into(buf, 0, version_field)
+        self.__set_buf(buf)
+        self._ip = self._port = None
+
+    def get_subtype(self):
+        """
+
+        :return: The subtype at the start of the body, like 'REQ'; The rest of the body is not decoded.
+        :rtype: str
+        """
+        header_size = self.get_header_size()
+        if self.__is_compact():
+            return Packet._compact_subtype_names.get(self._view[header_size], "")
+        return str(self._view[header_size:header_size + Packet.subtype_size], 'utf-8')
+
+    def set_subtype(self, subtype):
+        """
+        Rewrites the subtype at the start of the body in place, e.g. to turn a Reunion Hello into a Hello Back.
+
+        :param subtype: The new subtype.
+        :type subtype: str
+
+        :return:
+        """
+        header_size = self.get_header_size()
+        compact = self.__is_compact()
+        buf = self.__own_buf()
+        if compact:
+            buf[header_size] = Packet.compact_subtypes[subtype]
         else:
-            self.buf = copy.copy(buf)
-            self.version, self.type, self.length = struct.unpack(">hhi", buf[0:8])
-            self.type = str(self.type)
-            parts = struct.unpack(">hhhh", buf[8:16])
-            self.ip = '.'.join(str(int(part)).zfill(3) for part in parts)
-            self.port = struct.unpack(">i", buf[16:20])[0]
-            self.body = self.buf[20:].decode()
+            buf[header_size:header_size + Packet.subtype_size] = bytes(subtype, 'utf-8')
+        self.__set_buf(buf)
+        self._body = None
+
+    def __body_offset(self):
+        # Where the body continues after its subtype.
+        if self.__is_compact():
+            return Packet.compact_header_size + 1
+        return Packet.header_size + Packet.subtype_size
+
+    def get_body_address(self):
+        """
+        The address right after the subtype, in a Register Request or an Advertise Response.
+
+        :return: (ip, port)
+        :rtype: tuple
+        """
+        offset = self.__body_offset()
+        if self.__is_compact():
+            return self.__unpack_address(offset)
+        return str(self._view[offset:offset + 15], 'utf-8'), int(bytes(self._view[offset + 15:offset + 20]))
+
+    def get_body_option(self):
+        """
+        The optional number after the body address: Capacity of a Register Request or Server Depth of an Advertise
+        Response.
+
+        :return: The number, or None if the sender did not put one.
+        :rtype: int
+        """
+        offset = self.__body_offset() + (Packet._compact_address_struct.size if self.__is_compact() else 20)
+        if len(self._view) <= offset:
+            return None
+        if self.__is_compact():
+            return int.from_bytes(self._view[offset:], 'big')
+        return int(bytes(self._view[offset:]))
+
+    def is_register_ack(self):
+        """
+
+        :return: Whether the body continues with ACK after its subtype, as in a Register Response.
+        :rtype: bool
+        """
+        offset = self.__body_offset()
+        return bytes(self._view[offset:offset + 3]) == b"ACK"
+
+    def get_fragment_info(self):
+        """
+        Decodes the fields a Fragment carries before its data.
+
+        :return: (origin, stream ID, offset, total length); The origin is an (ip, port).
+        :rtype: tuple
+        """
+        offset = self.get_header_size()
+        if self.__is_compact():
+            origin = self.__unpack_address(offset)
+            return (origin,) + Packet._compact_fragment_struct.unpack_from(self._view,
+                                                                           offset + Packet._compact_address_struct.size)
+        origin = str(self._view[offset:offset + 15], 'utf-8'), int(bytes(self._view[offset + 15:offset + 20]))
+        size = Packet.fragment_number_size
+        offset += 20
+        return (origin,) + tuple(int(bytes(self._view[offset + i * size:offset + (i + 1) * size])) for i in range(3))
+
+    def get_fragment_data(self):
+        """
+        The part of the message a Fragment carries, without any copy.
+
+        :return: Fragment data
+        :rtype: memoryview
+        """
+        if self.__is_compact():
+            offset = Packet.compact_header_size + Packet._compact_address_struct.size + \
+                     Packet._compact_fragment_struct.size
+        else:
+            offset = Packet.header_size + 20 + 3 * Packet.fragment_number_size
+        return self._view[offset:]
+
+    def __reunion_layout(self):
+        # (offset of Number of Entries, its size, size of an entry)
+        if self.__is_compact():
+            return (Packet.compact_header_size + 1, Packet._compact_count_struct.size,
+                    Packet._compact_address_struct.size)
+        if self.get_subtype() == "AGG":
+            return Packet.header_size + Packet.subtype_size, 5, 20
+        return Packet.header_size + Packet.subtype_size, 2, 20
+
+    def get_reunion_entry_count(self):
+        """
+
+        :return: Number of Entries field of a Reunion packet.
+        :rtype: int
+        """
+        count_offset, count_size, entry_size = self.__reunion_layout()
+        if self.__is_compact():
+            return Packet._compact_count_struct.unpack_from(self._view, count_offset)[0]
+        return int(bytes(self._view[count_offset:count_offset + count_size]))
+
+    def get_reunion_entry(self, index):
+        """
+        Decodes a single entry of a Reunion packet.
+
+        :param index: Index of the entry; Negative indices count from the last one.
+        :type index: int
+
+        :return: (ip, port) of the entry.
+        :rtype: tuple
+        """
+        count_offset, count_size, entry_size = self.__reunion_layout()
+        if index < 0:
+            index += self.get_reunion_entry_count()
+        offset = count_offset + count_size + index * entry_size
+        if self.__is_compact():
+            return self.__unpack_address(offset)
+        return str(self._view[offset:offset + 15], 'utf-8'), int(bytes(self._view[offset + 15:offset + 20]))
+
+    def get_reunion_entries(self):
+        """
+
+        :return: [(ip0, port0), (ip1, port1), ...] All entries of a Reunion packet.
+        :rtype: list
+        """
+        return [self.get_reunion_entry(i) for i in range(self.get_reunion_entry_count())]
+
+    def append_reunion_entry(self, address):
+        """
+        Appends an entry to the end of a Reunion packet in place; Only Number of Entries and Length are patched, the
+        other entries are neither decoded nor encoded again.
+
+        :param address: (ip, port) of the new entry.
+        :type address: tuple
+
+        :return:
+        """
+        layout = self.__reunion_layout()
+        count = self.get_reunion_entry_count()
+        entry = Packet.pack_address(address, self.version)
+        buf = self.__own_buf()
+        buf += entry
+        self.__set_reunion_entry_count(buf, layout, count + 1)
+
+    def pop_reunion_entry(self):
+        """
+        Strips the last entry of a Reunion packet in place.
+
+        :return: (ip, port) of the stripped entry.
+        :rtype: tuple
+        """
+        layout = self.__reunion_layout()
+        count = self.get_reunion_entry_count()
+        entry = self.get_reunion_entry(count - 1)
+        buf = self.__own_buf()
+        del buf[len(buf) - layout[2]:]
+        self.__set_reunion_entry_count(buf, layout, count - 1)
+        return entry
+
+    def __set_reunion_entry_count(self, buf, layout, count):
+        count_offset, count_size, entry_size = layout
+        if self.version == Packet.compact_version:
+            Packet._compact_count_struct.pack_into(buf, count_offset, count)
+        else:
+            buf[count_offset:count_offset + count_size] = bytes(str(count).zfill(count_size), 'utf-8')
+        Packet._length_struct.pack_into(buf, 4, len(buf))
+        self.__set_buf(buf)
+        self._length = self._body = None
+
+    def __own_buf(self):
+        # A bytearray only this packet refers to; Our memoryview is released so the bytearray can be resized.
+        if isinstance(self.buf, bytearray) and not self.is_compressed():
+            buf = self.buf
+        else:
+            buf = bytearray(self._view)
+        self._view.release()
+        return buf
+
+    def __set_buf(self, buf):
+        self.buf = buf
+        self._plain = memoryview(buf)
+        self._flags = None
 
     def get_header(self):
         """
@@ -218,7 +817,13 @@ class Packet:
         :rtype: str
         """
         header = ""
-        header += "Body:" + str(self.get_body())
+        if self.get_type() == Type.message or self.get_type() == Type.fragment:
+            # Payloads are only decoded by their consumer.
+            header += "Body:<" + str(len(self.get_payload())) + " bytes>"
+        elif self.__is_compact():
+            header += "Body:" + str(bytes(self.get_payload()))
+        else:
+            header += "Body:" + str(self.get_body())
         header += "  Version:" + str(self.get_version())
         header += "  Type:" + str(self.get_type())
         header += "  Length:" + str(self.get_length())
@@ -252,20 +857,37 @@ class Packet:
 
     def get_body(self):
         """
+        Decodes the body as UTF-8; It is decoded only once.
+
+        Warnings:
+            1. Binary bodies can not be decoded; use get_payload for them.
 
         :return: Packet body
         :rtype: str
         """
         return self.body
 
+    def get_payload(self):
+        """
+        The body without any copy or decoding, e.g. the payload of a Message.
+
+        :return: Packet body
+        :rtype: memoryview
+        """
+        return self._view[self.get_header_size():]
+
     def get_buf(self):
         """
-        In this function, we will make our final buffer that represents the Packet with the Struct class methods.
+        Returns the encoded packet.
+
+        Warnings:
+            1. The buffer is shared with the packet and is not copied; treat it as read-only.
+            2. Don't change the packet in place after its buffer is added to an out buffer.
 
         :return The parsed packet to the network format.
-        :rtype: bytearray
+        :rtype: bytes | memoryview
         """
-        return copy.copy(self.buf)
+        return self.buf
 
     def get_source_server_ip(self):
         """
@@ -295,9 +917,40 @@ class Packet:
 class PacketFactory:
     """
     This class is only for making Packet objects.
+
+    Packets are packed straight into one preallocated bytearray. A factory bound to the source address its Peer sends
+    from keeps the header of every packet type and the body entry of that address packed, so making one of our own
+    packets only patches the Length field and copies the body.
     """
     version = 0
 
+    def __init__(self, version=None, source_address=None, capabilities=0):
+        """
+        :param version: Protocol version of the packets we make; None means PacketFactory.version. Bodies are binary
+                        for Packet.compact_version and text otherwise.
+        :param source_address: The source server address most of our packets are sent from.
+        :param capabilities: The Packet.capability_flags we tell the receivers of our packets.
+
+        :type version: int
+        :type source_address: tuple
+        :type capabilities: int
+        """
+        if version is not None:
+            self.version = version
+        self.flags = capabilities
+        self.source_address = source_address
+        if self.__is_compact():
+            self._subtypes = {name: bytes((code,)) for name, code in Packet.compact_subtypes.items()}
+        else:
+            self._subtypes = {name: bytes(name, 'utf-8') for name in Packet.compact_subtypes}
+        # Header of every packet type from source_address, with a zero Length.
+        self._headers = {}
+        self._source_entry = None
+        if source_address is not None:
+            self._source_entry = Packet.pack_address(source_address, self.version)
+            for type in (Type.register, Type.advertise, Type.join, Type.message, Type.reunion, Type.fragment):
+                self._headers[type] = self.__pack_header(type, source_address)
+
     @staticmethod
     def parse_buffer(buffer):
         """
@@ -311,8 +964,45 @@ class PacketFactory:
         """
         pass
 
-    @staticmethod
-    def new_reunion_packet(type, source_address, nodes_array):
+    def __is_compact(self):
+        return self.version == Packet.compact_version
+
+    def __pack_header(self, type, source_address):
+        parts = [int(part) for part in source_address[0].split('.')]
+        header_struct = Packet._compact_header_struct if self.__is_compact() else Packet._header_struct
+        return header_struct.pack(self.version | self.flags, int(type), 0, parts[0], parts[1], parts[2], parts[3],
+                                  int(source_address[1]))
+
+    def __pack_address(self, address):
+        if self._source_entry is not None and address == self.source_address:
+            return self._source_entry
+        return Packet.pack_address(address, self.version)
+
+    def __entries(self, nodes_array, count_size):
+        if self.__is_compact():
+            count = Packet._compact_count_struct.pack(len(nodes_array))
+        else:
+            count = bytes(str(len(nodes_array)).zfill(count_size), 'utf-8')
+        return [count] + [self.__pack_address(address) for address in nodes_array]
+
+    def __new_packet(self, type, source_address, body_parts):
+        if self._headers and source_address == self.source_address:
+            header = self._headers[type]
+        else:
+            header = self.__pack_header(type, source_address)
+        size = len(header)
+        for part in body_parts:
+            size += len(part)
+        buf = bytearray(size)
+        buf[:len(header)] = header
+        Packet._length_struct.pack_into(buf, 4, size)
+        offset = len(header)
+        for part in body_parts:
+            buf[offset:offset + len(part)] = part
+            offset += len(part)
+        return Packet(buf=buf)
+
+    def new_reunion_packet(self, type, source_address, nodes_array):
         """
         :param type: Reunion Hello (REQ) or Reunion Hello Back (RES)
         :param source_address: IP/Port address of the packet sender.
@@ -325,44 +1015,53 @@ class PacketFactory:
         :return New reunion packet.
         :rtype Packet
         """
+        if type != "REQ":
+            nodes_array = nodes_array[::-1]
+        return self.__new_packet(Type.reunion, source_address, [self._subtypes[type]] + self.__entries(nodes_array, 2))
 
-        body = ""
-        body += type
-        body += str(len(nodes_array)).zfill(2)
-        if type == "REQ":
-            for i in range(len(nodes_array)):
-                body += Node.parse_ip(nodes_array[i][0])
-                body += Node.parse_port(nodes_array[i][1])
-        else:
-            for i in range(len(nodes_array) - 1, -1, -1):
-                body += Node.parse_ip(nodes_array[i][0])
-                body += Node.parse_port(nodes_array[i][1])
-        return Packet(None, PacketFactory.version, Type.reunion, source_address[0], source_address[1], body)
+    def new_aggregated_reunion_packet(self, type, source_address, nodes_array=()):
+        """
+        :param type: Aggregated Hello (AGG) or Aggregated Hello Back (AGB)
+        :param source_address: IP/Port address of the packet sender.
+        :param nodes_array: [(ip0, port0), (ip1, port1), ...] Addresses of the live nodes, only for Aggregated Hello.
 
-    @staticmethod
-    def new_advertise_packet(type, source_server_address, neighbour=None):
+        :type type: str
+        :type source_address: tuple
+        :type nodes_array: list
+
+        :return New aggregated reunion packet.
+        :rtype Packet
+        """
+        body_parts = [self._subtypes[type]]
+        if type != "AGB":
+            body_parts += self.__entries(nodes_array, 5)
+        return self.__new_packet(Type.reunion, source_address, body_parts)
+
+    def new_advertise_packet(self, type, source_server_address, neighbour=None, depth=None):
         """
         :param type: Type of Advertise packet
         :param source_server_address Server address of the packet sender.
         :param neighbour: The neighbour for advertise response packet; The format is like ('192.168.001.001', '05335').
+        :param depth: Depth of the neighbour in the network tree, for advertise response packet.
 
         :type type: str
         :type source_server_address: tuple
         :type neighbour: tuple
+        :type depth: int
 
         :return New advertise packet.
         :rtype Packet
 
         """
-        body = ""
-        body += type
+        body_parts = [self._subtypes[type]]
         if type == "RES":
-            body += Node.parse_ip(neighbour[0])
-            body += Node.parse_port(neighbour[1])
-        return Packet(None, PacketFactory.version, Type.advertise, source_server_address[0], source_server_address[1], body)
+            body_parts.append(self.__pack_address(neighbour))
+            if depth is not None:
+                body_parts.append(depth.to_bytes(2, 'big') if self.__is_compact()
+                                  else bytes(str(depth).zfill(3), 'utf-8'))
+        return self.__new_packet(Type.advertise, source_server_address, body_parts)
 
-    @staticmethod
-    def new_join_packet(source_server_address):
+    def new_join_packet(self, source_server_address):
         """
         :param source_server_address: Server address of the packet sender.
 
@@ -372,50 +1071,107 @@ class PacketFactory:
         :rtype Packet
 
         """
-        body = "JOIN"
-        return Packet(None, PacketFactory.version, Type.join, source_server_address[0], source_server_address[1],
-                      body)
-    @staticmethod
-    def new_register_packet(type, source_server_address, address=(None, None)):
+        return self.__new_packet(Type.join, source_server_address, [] if self.__is_compact() else [b"JOIN"])
+
+    def new_register_packet(self, type, source_server_address, address=(None, None), capacity=None):
         """
         :param type: Type of Register packet
         :param source_server_address: Server address of the packet sender.
         :param address: If 'type' is 'request' we need an address; The format is like ('192.168.001.001', '05335').
+        :param capacity: If 'type' is 'request', the number of children the node accepts, from 1 to
+                         Packet.max_capacity; None lets the root decide.
 
         :type type: str
         :type source_server_address: tuple
         :type address: tuple
+        :type capacity: int
 
         :return New Register packet.
         :rtype Packet
 
         """
-        body = ""
-        body += type
+        body_parts = [self._subtypes[type]]
         if type == "REQ":
-            body += Node.parse_ip(address[0])
-            body += Node.parse_port(address[1])
+            body_parts.append(self.__pack_address(address))
+            if capacity is not None:
+                body_parts.append(capacity.to_bytes(1, 'big') if self.__is_compact()
+                                  else bytes(str(capacity).zfill(2), 'utf-8'))
         else:
-            body += "ACK"
-        return Packet(None, PacketFactory.version, Type.register, source_server_address[0], source_server_address[1],
-                      body)
+            body_parts.append(b"ACK")
+        return self.__new_packet(Type.register, source_server_address, body_parts)
 
-    @staticmethod
-    def new_message_packet(message, source_server_address):
+    def new_message_packet(self, message, source_server_address):
         """
         Packet for sending a broadcast message to the whole network.
 
-        :param message: Our message
+        :param message: Our message; A str is encoded as UTF-8 and anything else is carried as it is.
         :param source_server_address: Server address of the packet sender.
 
-        :type message: str
+        :type message: str | bytes | bytearray | memoryview
         :type source_server_address: tuple
 
         :return: New Message packet.
         :rtype: Packet
         """
-        return Packet(None, PacketFactory.version, Type.message, source_server_address[0], source_server_address[1],
-                      message)
+        if isinstance(message, str):
+            message = bytes(message, 'utf-8')
+        elif isinstance(message, memoryview):
+            message = message.cast('B')
+        return self.__new_packet(Type.message, source_server_address, [message])
+
+    def new_fragment_packet(self, origin, stream_id, offset, total_length, data, source_server_address):
+        """
+        Packet for one part of a message that is too large to be sent in one Message packet.
+
+        :param origin: Server address of the peer that sent the message.
+        :param stream_id: Number the origin gave the message.
+        :param offset: Where 'data' starts in the message.
+        :param total_length: Length of the whole message.
+        :param data: The part of the message.
+        :param source_server_address: Server address of the packet sender.
+
+        :type origin: tuple
+        :type stream_id: int
+        :type offset: int
+        :type total_length: int
+        :type data: bytes | bytearray | memoryview
+        :type source_server_address: tuple
+
+        :return: New Fragment packet.
+        :rtype: Packet
+        """
+        if self.__is_compact():
+            numbers = Packet._compact_fragment_struct.pack(stream_id, offset, total_length)
+        else:
+            size = Packet.fragment_number_size
+            numbers = bytes(str(stream_id).zfill(size) + str(offset).zfill(size) + str(total_length).zfill(size),
+                            'utf-8')
+        return self.__new_packet(Type.fragment, source_server_address, [self.__pack_address(origin), numbers, data])
+
+    def new_fragment_packets(self, message, source_server_address, stream_id, fragment_size):
+        """
+        Splits a message into Fragment packets of one stream; They are made one at a time, as they are consumed.
+
+        :param message: Our message; A str is encoded as UTF-8.
+        :param source_server_address: Server address of the packet sender, which is also the origin of the stream.
+        :param stream_id: A number that no other stream of the sender is using.
+        :param fragment_size: Maximum number of message bytes in one Fragment.
+
+        :type message: str | bytes | bytearray | memoryview
+        :type source_server_address: tuple
+        :type stream_id: int
+        :type fragment_size: int
+
+        :return: Fragment packets in order.
+        :rtype: generator
+        """
+        if isinstance(message, str):
+            message = bytes(message, 'utf-8')
+        with memoryview(message) as view:
+            view = view.cast('B')
+            for offset in range(0, len(view), fragment_size):
+                yield self.new_fragment_packet(source_server_address, stream_id, offset, len(view),
+                                               view[offset:offset + fragment_size], source_server_address)
 
 
 if __name__ == "__main__":
@@ -7,6 +7,8 @@ from src.UserInterface import UserInterface, GraphicalUserInterface
 from src.tools.Node import Node, LostConnection
 from src.tools.SemiNode import SemiNode
 from src.tools.NetworkGraph import NetworkGraph, GraphNode
+from collections import deque
+import itertools
 import time
 import threading
 
@@ -21,9 +23,22 @@ import threading
 class Peer:
     INITIAL_TIME_FOR_REUNION = 8
     SEND_REUNION_INTERVAL = 4
-    REUNION_BACK_TIMEOUT = 4 + 2 * (8 * 2.5) + 2
-
-    def __init__(self, server_ip, server_port, is_root=False, root_address=None, gui=False, interface=None):
+    REUNION_HOP_TIME = 2.5
+    # Used until our depth in the network tree is known.
+    REUNION_BACK_TIMEOUT = 4 + 2 * (8 * REUNION_HOP_TIME) + 2
+    # Messages longer than this are sent as Fragments of this size.
+    FRAGMENT_SIZE = 32 * 1024
+    # Limits of the messages we rebuild from Fragments; A stream that stays silent for REASSEMBLY_TIMEOUT seconds is
+    # dropped.
+    MAX_MESSAGE_SIZE = 128 * 1024 * 1024
+    MAX_REASSEMBLY_BYTES = 256 * 1024 * 1024
+    REASSEMBLY_TIMEOUT = 60
+    # Fragments of our own messages are made only while no neighbour has this many bytes waiting to be sent.
+    FRAGMENT_WINDOW = 8 * FRAGMENT_SIZE
+
+    def __init__(self, server_ip, server_port, is_root=False, root_address=None, gui=False, interface=None,
+                 flush_delay=0, capacity=None, aggregate_reunion=False, protocol_version=None,
+                 compression_threshold=None, batch_frames=False, out_buff_limits=None, max_message_frame_size=None):
         """
         The Peer object constructor.
 
@@ -44,18 +59,74 @@ class Peer:
         :param server_port: Server Port address for this Peer that should be pass to Stream.
         :param is_root: Specify that is this Peer root or not.
         :param root_address: Root IP/Port address if we are a client.
+        :param flush_delay: Maximum seconds our main loop waits after waking up, so packets produced meanwhile are
+                            sent in the same flush; It stops waiting as soon as Stream.flush_bytes or
+                            Stream.flush_packets are received or queued.
+        :param capacity: Maximum number of children of this Peer; A client declares it when registering and for the
+                         root it is also the default for clients which do not declare one. None means 2, else it
+                         must be from 1 to Packet.max_capacity.
+        :param aggregate_reunion: Send one Aggregated Reunion Hello per interval for our whole sub-tree instead of our
+                                  own Reunion Hello; For the root, expect the Aggregated Hellos of the network, which
+                                  are up to one interval late per hop.
+        :param protocol_version: Version of the packets we make, e.g. Packet.compact_version; We decode every
+                                 version. None means PacketFactory.version.
+        :param compression_threshold: Compress the bodies of at least this many bytes for the neighbours which accept
+                                      it, and accept compressed packets ourselves; None turns compression off.
+        :param batch_frames: Pack the small packets we queue for a neighbour within one flush into Batch frames, if
+                             the neighbour batches too; A larger flush_delay puts more packets in a Batch.
+        :param out_buff_limits: Limits of the packets waiting for every neighbour, and what to drop when a slow
+                                neighbour reaches them; None leaves them unlimited.
+        :param max_message_frame_size: Longest Message packet we receive from the peers which send large messages in
+                                       one packet instead of as Fragments, e.g. Peer.MAX_MESSAGE_SIZE plus a header;
+                                       Every connection may buffer that much. None means FrameDecoder.max_frame_size.
 
         :type server_ip: str
         :type server_port: int
         :type is_root: bool
         :type root_address: tuple
+        :type flush_delay: float
+        :type capacity: int
+        :type aggregate_reunion: bool
+        :type protocol_version: int
+        :type compression_threshold: int
+        :type batch_frames: bool
+        :type out_buff_limits: OutBuffLimits
+        :type max_message_frame_size: int
         """
+        if capacity is not None and not 1 <= capacity <= Packet.max_capacity:
+            raise ValueError("Capacity must be from 1 to %d, not %d" % (Packet.max_capacity, capacity))
         self.has_gui = gui
+        self.flush_delay = flush_delay
+        self.capacity = capacity
+        self.aggregate_reunion = aggregate_reunion
+        self.compression_threshold = compression_threshold
+        self.batch_frames = batch_frames
+        # What we tell our neighbours we accept, on every packet we send or forward.
+        self.capabilities = 0
+        if compression_threshold is not None:
+            self.capabilities |= Packet.accepts_compression_flag
+        if batch_frames:
+            self.capabilities |= Packet.accepts_batches_flag
+        # Called with the payload and the sender of every arrived Message instead of showing it as text.
+        self.message_listener = None
+        # Messages being rebuilt from Fragments: (origin, stream ID) -> [buffer, received bytes, last arrival]
+        self.reassemblies = {}
+        self.reassembly_bytes = 0
+        self.stream_ids = itertools.count()
+        # Iterators over the Fragments of our messages that are still to be sent; The oldest message goes first.
+        self.outgoing_fragments = deque()
+        # Neighbours which missed a Fragment: (origin, stream ID) -> [their addresses, last Fragment time]
+        self.lost_fragment_streams = {}
 
         self.ip = Node.parse_ip(server_ip)
         self.port = server_port
-        self.stream = Stream(server_ip, server_port)
-        self.packet_factory = PacketFactory()
+        self.stream = self.new_stream(server_ip, server_port)
+        self.stream.set_out_buff_limits(out_buff_limits)
+        self.stream.max_message_frame_size = max_message_frame_size
+        self.stream.high_watermark_listener = self.handle_slow_neighbour
+        self.stream.low_watermark_listener = self.handle_recovered_neighbour
+        self.packet_factory = PacketFactory(protocol_version, source_address=(self.ip, self.port),
+                                            capabilities=self.capabilities)
 
         self.interface = interface
         self.parse_interface_thread = threading.Thread(target=self.handle_user_interface_buffer, daemon=True)
@@ -64,8 +135,11 @@ class Peer:
         self.root_address = root_address
         self.reunion_daemon = threading.Thread(target=self.run_reunion_daemon, daemon=True)
         if is_root:
-            root_node = GraphNode((server_ip, server_port))
-            self.network_graph = NetworkGraph(root_node)
+            capacity = 2 if capacity is None else capacity
+            root_node = GraphNode((server_ip, server_port), capacity)
+            hop_time = Peer.SEND_REUNION_INTERVAL if aggregate_reunion else Peer.REUNION_HOP_TIME
+            self.network_graph = NetworkGraph(root_node, default_capacity=capacity, reunion_hop_time=hop_time)
+            self.network_graph.reattach_listener = self.push_new_parent
 
         if not is_root:
             try:
@@ -76,7 +150,19 @@ class Peer:
             self.send_reunion_timer = 4
             self.last_reunion_back = 0
             self.is_alive = False
+            # Our depth in the network tree, as told by the root in Advertise Response.
+            self.depth = None
+            # Addresses our children reported in Aggregated Reunion Hellos since our last one.
+            self.reunion_entries = set()
+            self.reunion_entries_lock = threading.Lock()
+
+    def new_stream(self, server_ip, server_port):
+        """
 
+        :return: The Stream our Peer communicates through.
+        :rtype: Stream
+        """
+        return Stream(server_ip, server_port)
 
     def handle_user_interface_buffer(self):
         """
@@ -92,32 +178,36 @@ class Peer:
         :return:
         """
 
-        if self.is_root:
-            while True:
-                while len(self.interface.buffer) > 0:
-                    args = self.interface.buffer[0].split()
-                    command = args[0]
-                    self.interface.buffer = self.interface.buffer[1:]
-                    if command.lower() == "showmap" or command.lower() == "sm":
-                        self.network_graph.print_all()
-                    elif command.lower() == "sendmessage":
-                        if len(args) >= 1:
-                            self.send_message(args[1])
-                time.sleep(0.1)
-        else:
-            while True:
-                while len(self.interface.buffer) > 0:
-                    args = self.interface.buffer[0].split()
-                    command = args[0]
-                    self.interface.buffer = self.interface.buffer[1:]
-                    if command.lower() == "register":
-                        self.register()
-                    elif command.lower() == "advertise":
-                        self.advertise()
-                    elif command.lower() == "sendmessage":
-                        if len(args) >= 1:
-                            self.send_message(args[1])
-                time.sleep(0.1)
+        while True:
+            self.parse_user_interface_buffer()
+            time.sleep(0.1)
+
+    def parse_user_interface_buffer(self):
+        """
+        Runs every command buffered in our UserInterface since the last call.
+
+        :return:
+        """
+        if self.interface is None:
+            return
+        while len(self.interface.buffer) > 0:
+            args = self.interface.buffer[0].split()
+            command = args[0]
+            self.interface.buffer = self.interface.buffer[1:]
+            if self.is_root:
+                if command.lower() == "showmap" or command.lower() == "sm":
+                    self.network_graph.print_all()
+                elif command.lower() == "sendmessage":
+                    if len(args) >= 1:
+                        self.send_message(args[1])
+            else:
+                if command.lower() == "register":
+                    self.register()
+                elif command.lower() == "advertise":
+                    self.advertise()
+                elif command.lower() == "sendmessage":
+                    if len(args) >= 1:
+                        self.send_message(args[1])
 
     def run(self):
         """
@@ -128,7 +218,7 @@ class Peer:
             2. Handle all packets were received from our Stream server.
             3. Parse user_interface_buffer to make message packets.
             4. Send packets stored in nodes buffer of our Stream object.
-            5. ** sleep the current thread for 2 seconds **
+            5. Sleep until our Stream receives a packet or a packet is added to one of its nodes buffer.
 
         Warnings:
             1. At first check reunion daemon condition; Maybe we have a problem in this time
@@ -142,16 +232,39 @@ class Peer:
         self.parse_interface_thread.start()
         # TODO Warning 1?
         while True:
-            packet = self.parse_in_buf()
-            while packet is not None:
-                print("PACKET HEADER:", packet.get_header())
-                self.handle_packet(packet)
-                packet = self.parse_in_buf()
-            try:
-                self.stream.send_out_buf_messages()
-            except LostConnection as lc:
-                self.handle_lost_connection(lc.node)
-            time.sleep(2)
+            self.handle_stream()
+            self.stream.wait_for_activity()
+            if self.flush_delay > 0:
+                self.stream.wait_for_flush(self.flush_delay)
+
+    def handle_stream(self):
+        """
+        Handles every packet our Stream has received, then sends the packets stored in nodes buffer.
+
+        :return:
+        """
+        for packet in self.parse_in_buf():
+            print("PACKET HEADER:", packet.get_header())
+            self.handle_packet(packet)
+        while True:
+            sent = self.__send_pending_fragments()
+            for node in self.stream.send_out_buf_messages():
+                self.handle_lost_connection(node)
+            if not sent:
+                break
+
+    def __send_pending_fragments(self):
+        # Queues Fragments of our messages while our neighbours have room for them; The rest waits until their
+        # out_buff drains, which wakes our Stream up again. Returns whether any Fragment was queued.
+        sent = False
+        while self.outgoing_fragments and self.stream.get_broadcast_backlog() < Peer.FRAGMENT_WINDOW:
+            packet = next(self.outgoing_fragments[0], None)
+            if packet is None:
+                self.outgoing_fragments.popleft()
+                continue
+            self.__broadcast_fragment_packet(packet)
+            sent = True
+        return sent
 
     def run_reunion_daemon(self):
         """
@@ -171,7 +284,7 @@ class Peer:
             2. If we are a non-root Peer, save the time when you have sent your last Reunion Hello packet; You need this
                time for checking whether the Reunion was failed or not.
             3. For choosing time intervals you should wait until Reunion Hello or Reunion Hello Back arrival,
-               pay attention that our NetworkGraph depth will not be bigger than 8. (Do not forget main loop sleep time)
+               pay attention that the timeouts grow with our depth in the NetworkGraph (see reunion_back_timeout).
             4. Suppose that you are a non-root Peer and Reunion was failed, In this time you should make a new Advertise
                Request packet and send it through your register_connection to the root; Don't forget to send this packet
                here, because in the Reunion Failure mode our main loop will not work properly and everything will be got stock!
@@ -179,37 +292,105 @@ class Peer:
         :return:
         """
         interval = 0.1
-        if self.is_root:
-            while True:
-                self.network_graph.remove_all_expired_nodes()
-                time.sleep(interval)
-        else:
-            while True:
-                self.send_reunion_timer -= interval
-                if self.send_reunion_timer <= 0 and self.is_alive:
-                    self.send_reunion()
-                    self.send_reunion_timer = Peer.SEND_REUNION_INTERVAL
-                if time.time() - self.last_reunion_back > Peer.REUNION_BACK_TIMEOUT and self.is_alive:
-                    print("Time:", time.time(), "Last:", self.last_reunion_back, "Timeout!!")
-                    self.timeout()
+        while True:
+            self.handle_reunion(interval)
+            if self.is_root:
+                self.network_graph.wait_for_expiry()
+            else:
                 time.sleep(interval)
 
-    def send_broadcast_packet(self, broadcast_packet):
+    def handle_reunion(self, interval):
+        """
+        One step of the reunion daemon; It should run every 'interval' seconds, or for the root when the next node
+        expires.
+
+        :param interval: Seconds since the previous step.
+
+        :return:
+        """
+        if self.is_root:
+            self.network_graph.remove_all_expired_nodes()
+        else:
+            self.send_reunion_timer -= interval
+            if self.send_reunion_timer <= 0 and self.is_alive:
+                self.send_reunion()
+                self.send_reunion_timer = Peer.SEND_REUNION_INTERVAL
+            if time.time() - self.last_reunion_back > self.reunion_back_timeout() and self.is_alive:
+                print("Time:", time.time(), "Last:", self.last_reunion_back, "Timeout!!")
+                self.timeout()
+
+    def send_broadcast_packet(self, broadcast_packet, excluded_address=None, compressed_packet=None,
+                              excluded_addresses=()):
         """
 
         For setting broadcast packets buffer into Nodes out_buff.
 
         Warnings:
             1. Don't send Message packets through register_connections.
+            2. The packet is compressed once and the same copy goes to every neighbour which accepts it.
 
         :param broadcast_packet: The packet that should be broadcast through the network.
+        :param excluded_address: A neighbour address that should not get the packet, like the one it came from.
+        :param compressed_packet: The packet already compressed, e.g. as it arrived; None compresses it if we should.
+        :param excluded_addresses: More neighbour addresses that should not get the packet.
+
         :type broadcast_packet: Packet
+        :type excluded_address: tuple
+        :type compressed_packet: Packet
+        :type excluded_addresses: set
+
+        :return: Addresses of the neighbours that dropped the packet because their out buffers were full.
+        :rtype: list
+        """
+        if broadcast_packet.is_compressed():
+            compressed_packet, broadcast_packet = broadcast_packet, broadcast_packet.decompressed()
+        elif compressed_packet is None and self.compression_threshold is not None:
+            compressed_packet = broadcast_packet.compress(self.compression_threshold)
+        compressed_message = None if compressed_packet is None else compressed_packet.get_buf()
+        return self.stream.add_broadcast_message_to_out_buff(broadcast_packet.get_buf(),
+                                                             excluded_address=excluded_address,
+                                                             compressed_message=compressed_message,
+                                                             excluded_addresses=excluded_addresses)
+
+    def handle_slow_neighbour(self, node):
+        """
+        Called when the packets waiting for a neighbour reach the high watermark of our out_buff_limits; From here on
+        the neighbour may miss packets, as the policies of their types say.
+
+        :param node: The neighbour.
+        :type node: Node
+
+        :return:
+        """
+        print("Warning: Neighbour", node.get_server_address(), "is slow; waiting (bytes, packets):",
+              node.get_out_buff_size())
+
+    def handle_recovered_neighbour(self, node):
+        """
+        Called when the packets waiting for a slow neighbour are down to the low watermark again.
+
+        :param node: The neighbour.
+        :type node: Node
+
+        :return:
+        """
+        print("Neighbour", node.get_server_address(), "caught up; dropped packets so far:", node.dropped_packets)
+
+    def send_packet(self, address, packet):
+        """
+        Adds the packet to the out_buff of the neighbour, compressed if it accepts compressed packets.
+
+        :param address: Server address of the neighbour.
+        :param packet: The packet that should be sent.
+
+        :type address: tuple
+        :type packet: Packet
 
         :return:
         """
-        for node in self.stream.get_nodes():
-            if not node.is_register:
-                self.stream.add_message_to_out_buff(node.get_server_address(), broadcast_packet.get_buf())
+        if self.compression_threshold is not None and self.stream.accepts_compression(address):
+            packet = packet.compress(self.compression_threshold) or packet
+        self.stream.add_message_to_out_buff(address, packet.get_buf())
 
     def handle_packet(self, packet):
         """
@@ -230,6 +411,10 @@ class Peer:
 
         # TODO: packet validation
 
+        if self.capabilities:
+            self.stream.set_capabilities(packet.get_source_server_address(), packet.accepts_compression(),
+                                         self.batch_frames and packet.accepts_batches())
+
         if packet.get_type() == Type.register:
             self.__handle_register_packet(packet)
         elif packet.get_type() == Type.advertise:
@@ -240,6 +425,8 @@ class Peer:
             self.__handle_message_packet(packet)
         elif packet.get_type() == Type.reunion:
             self.__handle_reunion_packet(packet)
+        elif packet.get_type() == Type.fragment:
+            self.__handle_fragment_packet(packet)
 
     def __check_registered(self, source_address):
         """
@@ -262,7 +449,7 @@ class Peer:
 
         Response:
             When an Advertise Response packet type arrived we should update our parent peer and send a Join packet to the
-            new parent.
+            new parent. If it proposes the parent we are already joined to, the root only tells us our new depth.
 
         Code design suggestion:
             1. Start the Reunion daemon thread when the first Advertise Response packet received.
@@ -282,9 +469,8 @@ class Peer:
 
         :return:
         """
-        body = packet.get_body()
-        type = body[0:3]
-        print("RCVD packet:", packet.body)
+        type = packet.get_subtype()
+        print("RCVD packet:", type, "from", packet.get_source_server_address())
         if type == "REQ" and self.is_root:
             ip = packet.get_source_server_ip()
             port = int(packet.get_source_server_port())
@@ -294,19 +480,29 @@ class Peer:
                 return
             else:
                 print("Answering Ad REQ of", ip, port, "Parent:", parent_address[0], parent_address[1])
-                res = self.packet_factory.new_advertise_packet("RES", (self.ip, self.port), parent_address)
+                parent_depth = self.network_graph.find_node(parent_address[0], parent_address[1]).depth()
+                res = self.packet_factory.new_advertise_packet("RES", (self.ip, self.port), parent_address,
+                                                               parent_depth)
                 self.stream.add_message_to_out_buff((ip, port), res.get_buf())
+                # The sub-tree of a node that advertises again moves with it.
+                self.__push_depths((ip, port))
         elif type == "RES" and (not self.is_root):
-            server_ip = body[3:18]
-            server_port = int(body[18:23])
+            server_ip, server_port = packet.get_body_address()
             print("Proposed Parent:", server_ip, server_port)
+            parent_depth = packet.get_body_option()
+            if parent_depth is not None:
+                self.depth = parent_depth + 1
+            if self.is_alive and self.father_address == (server_ip, server_port):
+                return
 
             # remove former parent node
             if self.father_address is not None:
                 try:
                     parent_node = self.stream.get_node_by_server(self.father_address[0], self.father_address[1],
                                                                  only_not_registers=True)
-                    self.stream.remove_node(parent_node)
+                    # It is already gone if we lost the connection to it.
+                    if parent_node is not None:
+                        self.stream.remove_node(parent_node)
                 except ValueError as e:
                     print(repr(e))
                     traceback.print_exc()
@@ -337,13 +533,15 @@ class Peer:
         :type packet Packet
         :return:
         """
-        body = packet.get_body()
-        type = body[0:3]
+        type = packet.get_subtype()
         if type == "REQ" and self.is_root:
-            ip = body[3:18]
-            port = int(body[18:23])
+            ip, port = packet.get_body_address()
+            capacity = packet.get_body_option()
+            if capacity is not None and not 1 <= capacity <= Packet.max_capacity:
+                print("Warning: Ignoring capacity", capacity, "of", ip, port)
+                capacity = None
             print("Registering ", ip, port)
-            self.network_graph.register_node(ip, port)
+            self.network_graph.register_node(ip, port, capacity)
             try:
                 self.stream.add_node((ip, port), set_register_connection=True)
                 res = self.packet_factory.new_register_packet("RES", (self.ip, self.port))
@@ -351,7 +549,7 @@ class Peer:
             except LostConnection as lc:
                 print("Coudn't connect to registered node")
         elif type == "RES" and (not self.is_root):
-            if body[3:6] == "ACK":
+            if packet.is_register_ack():
                 print("Register ACKed")
 
     def __check_neighbour(self, address):
@@ -385,15 +583,129 @@ class Peer:
         if not self.__check_neighbour(sender):
             print("Ignored a Message from unknown source")
             return
-        body = packet.get_body()
+        self.__forward_broadcast_packet(packet, sender)
+        self.deliver_message(packet.get_payload(), sender)
+
+    def __forward_broadcast_packet(self, packet, sender, excluded_addresses=()):
+        # The payload is forwarded as it is; only the consumer decodes it, and a compressed one is not compressed again.
+        compressed = None
+        if packet.is_compressed():
+            compressed = packet.with_source((self.ip, self.port), self.capabilities)
+        forwarded = packet.decompressed().with_source((self.ip, self.port), self.capabilities)
+        return self.send_broadcast_packet(forwarded, excluded_address=sender, compressed_packet=compressed,
+                                          excluded_addresses=excluded_addresses)
+
+    def __broadcast_fragment_packet(self, packet, sender=None):
+        # Sends our own Fragment, or forwards one that arrived from the sender; A neighbour which missed a Fragment of
+        # a message can not rebuild it any more, so it gets none of the rest but the last one, which tells it to give
+        # the message up.
+        origin, stream_id, offset, total_length = packet.get_fragment_info()
+        key = (origin, stream_id)
+        last = offset + len(packet.get_fragment_data()) >= total_length
+        lost = self.lost_fragment_streams.get(key)
+        excluded = () if lost is None or last else lost[0]
+        if sender is None:
+            dropped = self.send_broadcast_packet(packet, excluded_addresses=excluded)
+        else:
+            dropped = self.__forward_broadcast_packet(packet, sender, excluded)
+        if last:
+            self.lost_fragment_streams.pop(key, None)
+        elif dropped:
+            print("Warning: Neighbours", dropped, "missed a Fragment of a message from", origin)
+            if lost is None:
+                lost = self.lost_fragment_streams[key] = [set(), 0]
+            lost[0].update(dropped)
+            lost[1] = time.time()
+
+    def __handle_fragment_packet(self, packet):
+        """
+        Forwards a Fragment to the other nodes as soon as it arrives, then adds it to the message it is a part of;
+        The message is delivered when its last byte has arrived.
+
+        Warnings:
+            1. Messages longer than MAX_MESSAGE_SIZE, or which would take our buffered Fragments over
+               MAX_REASSEMBLY_BYTES, are still forwarded but not delivered.
+            2. The Fragments of a message come in order, so one that does not start where the previous one ended means
+               a Fragment was dropped on the way; The message is given up at once instead of when it times out.
+
+        :param packet: Arrived fragment packet
+
+        :type packet Packet
+
+        :return:
+        """
+        sender = packet.get_source_server_address()
+        if not self.__check_neighbour(sender):
+            print("Ignored a Fragment from unknown source")
+            return
+        self.__broadcast_fragment_packet(packet, sender)
+        origin, stream_id, offset, total_length = packet.get_fragment_info()
+        data = packet.get_fragment_data()
+        if offset + len(data) > total_length:
+            print("Warning: Invalid Fragment")
+            return
+        key = (origin, stream_id)
+        now = time.time()
+        reassembly = self.reassemblies.get(key)
+        if reassembly is None:
+            if offset != 0:
+                # The rest of a message we have given up, or whose start we have missed.
+                return
+            self.__drop_stale_reassemblies(now)
+            if total_length > Peer.MAX_MESSAGE_SIZE or \
+                    self.reassembly_bytes + total_length > Peer.MAX_REASSEMBLY_BYTES:
+                print("Warning: Dropped a message of", total_length, "bytes from", origin)
+                return
+            reassembly = [bytearray(total_length), 0, now]
+            self.reassemblies[key] = reassembly
+            self.reassembly_bytes += total_length
+        elif len(reassembly[0]) != total_length:
+            print("Warning: Invalid Fragment")
+            return
+        elif offset != reassembly[1]:
+            print("Warning: Message from", origin, "missed a Fragment after", reassembly[1], "bytes")
+            del self.reassemblies[key]
+            self.reassembly_bytes -= total_length
+            return
+        reassembly[0][offset:offset + len(data)] = data
+        reassembly[1] += len(data)
+        reassembly[2] = now
+        if reassembly[1] >= total_length:
+            del self.reassemblies[key]
+            self.reassembly_bytes -= total_length
+            self.deliver_message(memoryview(reassembly[0]), sender)
+
+    def __drop_stale_reassemblies(self, now):
+        for key, reassembly in list(self.reassemblies.items()):
+            if now - reassembly[2] > Peer.REASSEMBLY_TIMEOUT:
+                print("Warning: Message from", key[0], "timed out after", reassembly[1], "bytes")
+                del self.reassemblies[key]
+                self.reassembly_bytes -= len(reassembly[0])
+        for key, lost in list(self.lost_fragment_streams.items()):
+            if now - lost[1] > Peer.REASSEMBLY_TIMEOUT:
+                del self.lost_fragment_streams[key]
+
+    def deliver_message(self, payload, sender):
+        """
+        Hands an arrived Message to its consumer: our message_listener if there is one, otherwise the user, as
+        UTF-8 text.
+
+        :param payload: The Message body; It is not copied and stays valid after the call.
+        :param sender: The neighbour it came from.
+
+        :type payload: memoryview
+        :type sender: tuple
+
+        :return:
+        """
+        if self.message_listener is not None:
+            self.message_listener(payload, sender)
+            return
+        body = str(payload, 'utf-8', 'replace')
         if self.has_gui:
             self.interface.append_message(body)
         else:
             print("Message Received:\n", body)
-        packet = self.packet_factory.new_message_packet(body, (self.ip, self.port))
-        for node in self.stream.get_nodes():
-            if node.get_server_address() != sender and (not node.is_register):
-                self.stream.add_message_to_out_buff(node.get_server_address(), packet.get_buf())
 
     def __handle_reunion_packet(self, packet):
         """
@@ -418,45 +730,73 @@ class Peer:
         :param packet: Arrived reunion packet
         :return:
         """
-        body = packet.get_body()
-        type = body[0:3]
-        number_of_entries = int(body[3:5])
-        entries = []
-        for i in range(number_of_entries):
-            entry_ip = body[5 + i * 20: 5 + i * 20 + 15]
-            entry_port = int(body[5 + i * 20 + 15: 5 + i * 20 + 20])
-            entries.append((entry_ip, entry_port))
+        type = packet.get_subtype()
+        if type == "AGG" or type == "AGB":
+            self.__handle_aggregated_reunion_packet(packet)
+            return
+        # Entries are read one at a time and the packet is forwarded in place, so a hop costs the same at any depth.
+        number_of_entries = packet.get_reunion_entry_count()
         if number_of_entries < 1:
             print("Warning: Invalid Reunion Packet")
             return
         if type == "REQ":
             if self.is_root:
-                self.network_graph.update_latest_reunion_time(entries[0])
-                first_hop = entries[-1]
-                entries.reverse()
-                res = self.packet_factory.new_reunion_packet("RES", (self.ip, self.port), entries)
-                self.stream.add_message_to_out_buff(first_hop, res.get_buf())
+                self.network_graph.update_latest_reunion_time(packet.get_reunion_entry(0))
+                first_hop = packet.get_reunion_entry(-1)
+                # Hello Back keeps the entries of the Hello in the same order.
+                packet.set_subtype("RES")
+                packet.set_source((self.ip, self.port), self.capabilities)
+                self.stream.add_message_to_out_buff(first_hop, packet.get_buf())
             else:
                 if not self.is_alive:
                     return
-                entries.append((self.ip, self.port))
-                res = self.packet_factory.new_reunion_packet("REQ", (self.ip, self.port), entries)
-                self.stream.add_message_to_out_buff(self.father_address, res.get_buf())
+                packet.append_reunion_entry((self.ip, self.port))
+                packet.set_source((self.ip, self.port), self.capabilities)
+                self.stream.add_message_to_out_buff(self.father_address, packet.get_buf())
 
         if type == "RES":
             if self.is_root:
                 print("Warning: Invalid Reunion Packet")
                 return
-            if (self.ip, self.port) == entries[0]:
+            if (self.ip, self.port) == packet.get_reunion_entry(0):
                 self.last_reunion_back = time.time()
                 return
-            if (self.ip, self.port) != entries[-1]:
+            if number_of_entries < 2 or (self.ip, self.port) != packet.get_reunion_entry(-1):
+                print("Warning: Invalid Reunion Packet")
+                return
+            packet.pop_reunion_entry()
+            next_hop = packet.get_reunion_entry(-1)
+            packet.set_source((self.ip, self.port), self.capabilities)
+            self.stream.add_message_to_out_buff(next_hop, packet.get_buf())
+
+    def __handle_aggregated_reunion_packet(self, packet):
+        """
+        Aggregated Hello:
+            If you are root Peer update the last Reunion Hello arrival of every address in the packet and answer the
+            sender with an Aggregated Hello Back; Otherwise keep the addresses for our next Aggregated Hello.
+
+        Aggregated Hello Back:
+            Our path to the root is alive; pass the packet to all of our children.
+
+        :param packet: Arrived aggregated reunion packet
+        :return:
+        """
+        if packet.get_subtype() == "AGG":
+            entries = packet.get_reunion_entries()
+            if self.is_root:
+                self.network_graph.update_latest_reunion_times(entries)
+                res = self.packet_factory.new_aggregated_reunion_packet("AGB", (self.ip, self.port))
+                self.stream.add_message_to_out_buff(packet.get_source_server_address(), res.get_buf())
+            elif self.is_alive:
+                with self.reunion_entries_lock:
+                    self.reunion_entries.update(entries)
+        else:
+            if self.is_root or packet.get_source_server_address() != self.father_address:
                 print("Warning: Invalid Reunion Packet")
                 return
-            entries = entries[0:-1]
-            next_hop = entries[-1]
-            res = self.packet_factory.new_reunion_packet("RES", (self.ip, self.port), entries)
-            self.stream.add_message_to_out_buff(next_hop, res.get_buf())
+            self.last_reunion_back = time.time()
+            self.send_broadcast_packet(packet.with_source((self.ip, self.port), self.capabilities),
+                                       excluded_address=self.father_address)
 
     def __handle_join_packet(self, packet):
         """
@@ -490,24 +830,33 @@ class Peer:
         return self.network_graph.find_parent_and_assign(sender[0], sender[1])
 
     def parse_in_buf(self):
-        buffer = self.stream.read_in_buf()
-        header_size = 20
-        if len(buffer) < header_size:
-            return None
-
-        packet = Packet(buf=buffer[0:20])
-        packet_length = packet.get_length()
-        if len(buffer) < packet_length:
-            return None
-        packet = Packet(buf=buffer[0:packet_length])
-        self.stream.delete_buffer(packet_length)
-        return packet
+        """
+        Drains every complete packet our Stream has received since the last call.
+
+        :return: Received packets in arrival order.
+        :rtype: list
+        """
+        packets = []
+        for frame in self.stream.read_in_buf():
+            packet = Packet(buf=frame)
+            if len(frame) < packet.get_header_size():
+                print("Warning: Invalid Packet Length")
+                continue
+            if packet.is_compressed():
+                try:
+                    packet.get_length()
+                except ValueError as e:
+                    print("Warning:", e)
+                    continue
+            packets.append(packet)
+        return packets
 
     def register(self):
         print("Register Command!")
         if self.is_root:
             return
-        req = self.packet_factory.new_register_packet("REQ", (self.ip, self.port), (self.ip, self.port))
+        req = self.packet_factory.new_register_packet("REQ", (self.ip, self.port), (self.ip, self.port),
+                                                      self.capacity)
         self.stream.add_message_to_out_buff(self.root_address, req.get_buf())
 
     def advertise(self):
@@ -517,13 +866,103 @@ class Peer:
         pass
 
     def send_message(self, message):
-        print("Message Command! Message:", message)
+        """
+        Broadcasts a Message to the whole network; A message longer than FRAGMENT_SIZE is sent as Fragments.
+
+        :param message: Text, or a binary payload that is delivered to the message_listener of the other peers as it
+                        is; A payload that is sent as Fragments is read as our out buffers drain, so it must not change
+                        afterwards.
+        :type message: str | bytes | bytearray | memoryview
+
+        :return:
+        """
+        print("Message Command! Message:", message if isinstance(message, str) else "<binary>")
+        if isinstance(message, str):
+            message = bytes(message, 'utf-8')
+        if memoryview(message).nbytes > Peer.FRAGMENT_SIZE:
+            # Every Fragment is sent on its own, so the next hop can forward it while the rest is on its way; They are
+            # made by our main loop as our out buffers drain, see FRAGMENT_WINDOW.
+            stream_id = next(self.stream_ids) % (1 << 32)
+            self.outgoing_fragments.append(self.packet_factory.new_fragment_packets(message, (self.ip, self.port),
+                                                                                     stream_id, Peer.FRAGMENT_SIZE))
+            self.stream.wakeup()
+            return
         packet = self.packet_factory.new_message_packet(message, (self.ip, self.port))
         self.send_broadcast_packet(packet)
 
     def send_reunion(self):
-        reunion_packet = self.packet_factory.new_reunion_packet("REQ", (self.ip, self.port), [(self.ip, self.port)])
-        self.stream.add_message_to_out_buff(self.father_address, reunion_packet.get_buf())
+        """
+        Sends our Reunion Hello, or in the aggregated mode one Aggregated Reunion Hello for us and the addresses our
+        children reported.
+
+        Warnings:
+            1. Addresses reported by children are passed on in the aggregated form even in the normal mode, so the
+               aggregated mode also works under parents which do not use it.
+
+        :return:
+        """
+        with self.reunion_entries_lock:
+            entries = list(self.reunion_entries)
+            self.reunion_entries.clear()
+        if self.aggregate_reunion:
+            entries.append((self.ip, self.port))
+        else:
+            reunion_packet = self.packet_factory.new_reunion_packet("REQ", (self.ip, self.port),
+                                                                    [(self.ip, self.port)])
+            self.send_packet(self.father_address, reunion_packet)
+        if entries:
+            reunion_packet = self.packet_factory.new_aggregated_reunion_packet("AGG", (self.ip, self.port), entries)
+            self.send_packet(self.father_address, reunion_packet)
+
+    def push_new_parent(self, node, parent):
+        """
+        Sends an Advertise Response to a node which our NetworkGraph moved, with its whole sub-tree, to a new parent
+        because its former parent expired.
+
+        The node handles it like the answer to an Advertise Request: it joins the new parent and its own children stay
+        connected to it, so none of them has to advertise again. Every node of the sub-tree also gets an Advertise
+        Response proposing the parent it already has, which only tells it its new depth.
+
+        Warnings:
+            1. This is called by the reunion daemon once the NetworkGraph is unlocked, so waiting for room in an out
+               buffer does not hold up the threads which use the graph.
+
+        :param node: The orphaned child.
+        :param parent: Its new parent.
+
+        :type node: GraphNode
+        :type parent: GraphNode
+
+        :return:
+        """
+        print("Reattaching", node.get_address(), "to", parent.get_address())
+        res = self.packet_factory.new_advertise_packet("RES", (self.ip, self.port), parent.get_address(),
+                                                       parent.depth())
+        try:
+            self.stream.add_message_to_out_buff(node.get_address(), res.get_buf())
+        except ValueError as e:
+            print(repr(e))
+        self.__push_depths(node.get_address())
+
+    def __push_depths(self, address):
+        # Tells every node in the sub-tree of a moved node its new depth, by proposing the parent it already has.
+        for moved, parent_address, parent_depth in self.network_graph.get_subtree_parents(address):
+            res = self.packet_factory.new_advertise_packet("RES", (self.ip, self.port), parent_address, parent_depth)
+            try:
+                self.stream.add_message_to_out_buff(moved, res.get_buf())
+            except ValueError as e:
+                print(repr(e))
+
+    def reunion_back_timeout(self):
+        """
+        A Reunion Hello and its Hello Back travel our depth twice; Waiting longer than that means the Reunion failed.
+
+        :return: Seconds to wait for a Reunion Hello Back.
+        :rtype: float
+        """
+        if self.depth is None:
+            return Peer.REUNION_BACK_TIMEOUT
+        return Peer.SEND_REUNION_INTERVAL + 2 * (self.depth * Peer.REUNION_HOP_TIME) + 2
 
     def timeout(self):
         self.is_alive = False
@@ -534,6 +973,6 @@ class Peer:
     def handle_lost_connection(self, node):
         self.stream.remove_node(node)
         print("Connection with ", node.get_server_address(), " lost")
-        if node.get_server_address() == self.father_address:
+        if not self.is_root and node.get_server_address() == self.father_address:
             print("Connection with father lost")
             self.timeout()
@@ -1,12 +1,26 @@
+from src.tools.simpletcp.clientsocket import ClientSocket
 from src.tools.simpletcp.tcpserver import TCPServer
 
-from src.tools.Node import Node
+from src.tools.FrameDecoder import FrameDecoder
+from src.tools.Node import Node, LostConnection
+import queue
+import selectors
+import socket
 import threading
 
 
 class Stream:
-
-    def __init__(self, ip, port):
+    # Maximum number of bytes read from a connection at once; Large enough for a whole Fragment.
+    receive_bytes = 64 * 1024
+    # Bytes or packets received or queued since our last flush which are worth handling and sending without waiting
+    # for the flush delay.
+    flush_bytes = 64 * 1024
+    flush_packets = 256
+    # Longest Message frame a connection may send, for the peers which send large messages in one packet instead of as
+    # Fragments; None means FrameDecoder.max_frame_size.
+    max_message_frame_size = None
+
+    def __init__(self, ip, port, send_acks=False, backlog=socket.SOMAXCONN):
         """
         The Stream object constructor.
 
@@ -16,13 +30,57 @@ class Stream:
 
         :param ip: 15 characters
         :param port: 5 characters
+        :param send_acks: Answer every read with a cumulative acknowledgement; Only needed when our neighbours want
+                          delivery confirmation.
+        :param backlog: Accept backlog of our TCPServer.
         """
 
         self.nodes = []
+        # Indexes of our nodes keyed by their normalized server address; register_connections are kept apart.
+        self._nodes_by_address = {}
+        self._register_nodes_by_address = {}
         self.ip = Node.parse_ip(ip)
         self.port = port
 
-        self._server_in_buf = b''
+        # Complete frames from every connection; filled by the TCPServer thread and drained by the Peer.
+        self._server_in_buf = queue.Queue()
+        # Frame decoders for every accepted connection, only touched by the TCPServer thread.
+        self._decoders = {}
+        self.send_acks = send_acks
+        self._received_bytes = {}
+        # Nodes that may have unsent messages; other threads add to it, so it is guarded by a lock.
+        self._dirty_nodes = set()
+        self._dirty_nodes_lock = threading.Lock()
+        # What was received or queued since our last flush, also guarded by _dirty_nodes_lock, and whether it is
+        # enough to flush.
+        self._queued_bytes = 0
+        self._queued_packets = 0
+        self._flush_due = threading.Event()
+        # OutBuffLimits of every node; None means unlimited out buffers.
+        self.out_buff_limits = None
+        # Called with a node when its out buffer fills up to the high watermark and when it drains again.
+        self.high_watermark_listener = None
+        self.low_watermark_listener = None
+        # The thread that sends our out buffers; It must never wait for room in them.
+        self._flush_thread = None
+
+        self.start_server(backlog)
+
+    def start_server(self, backlog):
+        """
+        Starts our TCPServer in a separate daemon Thread.
+
+        :param backlog: Accept backlog of our TCPServer.
+
+        :return:
+        """
+        # 'wait_for_activity' sleeps on this selector; 'wakeup' writes to the socket pair to interrupt it.
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
+        self._writable_watched = set()
 
         def callback(address, queue, data):
             """
@@ -33,14 +91,21 @@ class Stream:
             :param data: The data received from the socket.
             :return:
             """
-            queue.put(bytes('ACK', 'utf8'))
-            if type(data) == bytes:
-                self._server_in_buf += data
-            elif type(data) == str:
-                self._server_in_buf += bytes(data, "UTF-8")
-            # print("Data Received, New Buffer:", self.read_in_buf())
+            ack = self.receive(address, data)
+            if ack is not None:
+                queue.put(ack)
 
-        self.tcpserver = TCPServer(self.ip, self.port, callback)
+        def close_callback(address):
+            """
+            The callback function will run when a connection to our TCPServer is closed.
+
+            :param address: Source address.
+            :return:
+            """
+            self.forget_connection(address)
+
+        self.tcpserver = TCPServer(self.ip, self.port, callback, maximum_connections=backlog,
+                                   receive_bytes=self.receive_bytes, close_callback=close_callback)
 
         def run_sever():
             # print("TCPServer Started")
@@ -49,6 +114,103 @@ class Stream:
         server_thread = threading.Thread(target=run_sever, daemon=True)
         server_thread.start()
 
+    def receive(self, address, data):
+        """
+        Resolves frame boundaries of the data received on one connection and queues every completed frame.
+
+        :param address: Source address of the connection.
+        :param data: The data received from the socket.
+
+        :return: The cumulative acknowledgement that should be sent back, if we send them.
+        :rtype: bytes
+        """
+        if type(data) == str:
+            data = bytes(data, "UTF-8")
+        decoder = self._decoders.get(address)
+        if decoder is None:
+            decoder = FrameDecoder(max_message_frame_size=self.max_message_frame_size)
+            self._decoders[address] = decoder
+        frames = decoder.decode(data)
+        for frame in frames:
+            self._server_in_buf.put(frame)
+        if frames:
+            with self._dirty_nodes_lock:
+                self.__count_queued(sum(len(frame) for frame in frames), len(frames))
+            self.wakeup()
+        if self.send_acks:
+            received = self._received_bytes.get(address, 0) + len(data)
+            self._received_bytes[address] = received
+            return ClientSocket.ack_struct.pack(b'ACK', received)
+        return None
+
+    def forget_connection(self, address):
+        """
+        Drops everything we kept for a closed connection.
+
+        :param address: Source address of the connection.
+
+        :return:
+        """
+        self._decoders.pop(address, None)
+        self._received_bytes.pop(address, None)
+
+    def new_node(self, server_address, set_register_connection):
+        """
+
+        :return: A new Node connected to 'server_address'.
+        :rtype: Node
+        """
+        # Our neighbours acknowledge what we send when we do the same for them.
+        return Node(server_address, set_root=False, set_register=set_register_connection, expect_acks=self.send_acks)
+
+    def wakeup(self):
+        """
+        Interrupts 'wait_for_activity'; Safe to call from any thread.
+
+        :return:
+        """
+        try:
+            self._wakeup_writer.send(b'\0')
+        except OSError:
+            # The socket buffer is full, so a wakeup is already pending.
+            pass
+
+    def watch_writable(self, node, watch):
+        """
+        Makes 'wait_for_activity' also return when the node socket becomes writable, while it has unsent messages.
+
+        :param node: The node whose socket should be watched.
+        :param watch: Start or stop watching.
+
+        :type node: Node
+        :type watch: bool
+
+        :return:
+        """
+        if watch and node not in self._writable_watched:
+            self._selector.register(node, selectors.EVENT_WRITE)
+            self._writable_watched.add(node)
+        elif not watch and node in self._writable_watched:
+            self._selector.unregister(node)
+            self._writable_watched.discard(node)
+
+    def wait_for_activity(self, timeout=None):
+        """
+        Sleeps until a frame is received, a message is added to an out buffer or a node with unsent messages becomes
+        writable.
+
+        :param timeout: Maximum seconds to sleep; None means no limit.
+
+        :return:
+        """
+        for key, events in self._selector.select(timeout):
+            if key.fileobj is self._wakeup_reader:
+                try:
+                    while self._wakeup_reader.recv(4096):
+                        pass
+                except OSError:
+                    pass
+
     def get_server_address(self):
         """
 
@@ -63,7 +225,11 @@ class Stream:
 
         :return:
         """
-        self._server_in_buf.clear()
+        try:
+            while True:
+                self._server_in_buf.get_nowait()
+        except queue.Empty:
+            pass
 
     def add_node(self, server_address, set_register_connection=False):
         """
@@ -77,12 +243,38 @@ class Stream:
 
         :return:
         """
-        for node in self.nodes:
-            if node.is_register == set_register_connection and node.get_server_address() == server_address:
-                return
-        node = Node(server_address, set_root=False, set_register=set_register_connection)
+        index = self._register_nodes_by_address if set_register_connection else self._nodes_by_address
+        if Stream.__find(index, server_address[0], server_address[1]) is not None:
+            return
+        node = self.new_node(server_address, set_register_connection)
+        self.__configure(node)
         self.nodes.append(node)
-        pass
+        index[node.get_server_address()] = node
+
+    def set_out_buff_limits(self, limits):
+        """
+        Limits the out buffer of every node, including the ones added later.
+
+        :param limits: The limits; None removes them.
+        :type limits: OutBuffLimits
+
+        :return:
+        """
+        self.out_buff_limits = limits
+        for node in self.nodes:
+            self.__configure(node)
+
+    def __configure(self, node):
+        node.limits = self.out_buff_limits
+        node.watermark_listener = self.__watermark_crossed
+
+    def __watermark_crossed(self, node, above):
+        listener = self.high_watermark_listener if above else self.low_watermark_listener
+        if listener is not None:
+            listener(node)
+
+    def __may_block(self):
+        return self._flush_thread is not None and threading.current_thread() is not self._flush_thread
 
     def remove_node(self, node):
         """
@@ -96,8 +288,13 @@ class Stream:
 
         :return:
         """
-        if node in self.nodes:
+        if self.__contains(node):
+            index = self._register_nodes_by_address if node.is_register else self._nodes_by_address
+            del index[node.get_server_address()]
             self.nodes.remove(node)
+            self.watch_writable(node, False)
+            with self._dirty_nodes_lock:
+                self._dirty_nodes.discard(node)
             node.close()
 
     def get_node_by_server(self, ip, port, only_not_registers=False):
@@ -110,15 +307,53 @@ class Stream:
 
         :param ip: input address IP
         :param port: input address Port
+        :param only_not_registers: Ignore register_connections.
 
-        :return: The node that input address.
+        :return: The node that input address; A node which is not a register_connection is preferred.
         :rtype: Node
         """
-        for node in self.nodes:
-            if node.get_server_address() == (ip, port):
-                if not (node.is_register and only_not_registers):
-                    return node
-        return None
+        node = Stream.__find(self._nodes_by_address, ip, port)
+        if node is None and not only_not_registers:
+            node = Stream.__find(self._register_nodes_by_address, ip, port)
+        return node
+
+    def set_capabilities(self, address, accepts_compression, accepts_batches):
+        """
+        Records whether the peer with the input server address accepts compressed packets and Batch frames; Unknown
+        addresses are ignored.
+
+        :param address: Server address of the peer.
+        :param accepts_compression: What the last packet of the peer said.
+        :param accepts_batches: Whether we should send Batch frames to the peer.
+
+        :return:
+        """
+        node = self.get_node_by_server(address[0], address[1])
+        if node is not None:
+            node.accepts_compression = accepts_compression
+            node.accepts_batches = accepts_batches
+
+    def accepts_compression(self, address):
+        """
+
+        :param address: Server address of the peer.
+
+        :return: Whether we may send compressed packets to the peer.
+        :rtype: bool
+        """
+        node = self.get_node_by_server(address[0], address[1])
+        return node is not None and node.accepts_compression
+
+    def __contains(self, node):
+        index = self._register_nodes_by_address if node.is_register else self._nodes_by_address
+        return index.get(node.get_server_address()) is node
+
+    @staticmethod
+    def __find(index, ip, port):
+        node = index.get((ip, port))
+        if node is None:
+            node = index.get((Node.parse_ip(ip), int(port)))
+        return node
 
     def add_message_to_out_buff(self, address, message):
         """
@@ -130,23 +365,99 @@ class Stream:
 
         Warnings:
             1. Check whether the node address is in our nodes or not.
+            2. If the out buffer of the node is full, the message may be dropped, or for a thread that does not send our
+               out buffers, wait for room; See OutBuffLimits.
 
-        :return:
+        :return: Whether the message was added.
+        :rtype: bool
         """
         node = self.get_node_by_server(address[0], address[1])
         if node is not None:
-            node.add_message_to_out_buff(message)
+            added = node.add_message_to_out_buff(message, self.__may_block())
+            with self._dirty_nodes_lock:
+                self._dirty_nodes.add(node)
+                self.__count_queued(len(message), 1)
+            self.wakeup()
+            return added
         else:
             raise ValueError("Node not in Stream")
 
+    def add_broadcast_message_to_out_buff(self, message, excluded_address=None, compressed_message=None,
+                                          excluded_addresses=()):
+        """
+        Adds the same message object to the output buffer of every node that is not a register_connection.
+
+        :param message: The encoded message; It is shared between the nodes, so it must not change afterwards.
+        :param excluded_address: A node address that should not get the message, like the one it came from.
+        :param compressed_message: The same message compressed, for the nodes which accept it.
+        :param excluded_addresses: More node addresses that should not get the message.
+
+        :type message: bytes
+        :type excluded_address: tuple
+        :type compressed_message: bytes
+        :type excluded_addresses: set
+
+        :return: Server addresses of the nodes that dropped the message because their out buffers were full.
+        :rtype: list
+        """
+        # The nodes may wait for room, so no lock is held while the message is added.
+        may_block = self.__may_block()
+        nodes = [node for node in list(self.nodes)
+                 if not node.is_register and node.get_server_address() != excluded_address and
+                 node.get_server_address() not in excluded_addresses]
+        dropped = []
+        for node in nodes:
+            if compressed_message is not None and node.accepts_compression:
+                added = node.add_message_to_out_buff(compressed_message, may_block)
+            else:
+                added = node.add_message_to_out_buff(message, may_block)
+            if not added:
+                dropped.append(node.get_server_address())
+        with self._dirty_nodes_lock:
+            self._dirty_nodes.update(nodes)
+            self.__count_queued(len(message) * len(nodes), len(nodes))
+        self.wakeup()
+        return dropped
+
+    def __count_queued(self, size, packets):
+        self._queued_bytes += size
+        self._queued_packets += packets
+        if self._queued_bytes >= self.flush_bytes or self._queued_packets >= self.flush_packets:
+            self._flush_due.set()
+
+    def wait_for_flush(self, timeout):
+        """
+        Sleeps until flush_bytes or flush_packets are received or queued since our last flush, or for at most
+        'timeout' seconds.
+
+        :param timeout: Maximum seconds to sleep.
+
+        :return:
+        """
+        self._flush_due.wait(timeout)
+
+    def get_broadcast_backlog(self):
+        """
+
+        :return: Most bytes waiting in the out_buff of a node that is not a register_connection.
+        :rtype: int
+        """
+        return max([node.get_out_buff_size()[0] for node in list(self.nodes) if not node.is_register], default=0)
+
     def read_in_buf(self):
         """
-        Only returns the input buffer of our TCPServer.
+        Drains the complete frames our TCPServer has received from all connections.
 
-        :return: TCPServer input buffer.
-        :rtype: bytearray
+        :return: Complete frames in arrival order.
+        :rtype: list
         """
-        return self._server_in_buf
+        frames = []
+        try:
+            while True:
+                frames.append(self._server_in_buf.get_nowait())
+        except queue.Empty:
+            pass
+        return frames
 
     def send_messages_to_node(self, node):
         """
@@ -159,22 +470,47 @@ class Stream:
         :param node:
         :type node Node
 
-        :return:
+        :return: Whether every buffered message was written; If not, the rest waits for the socket to become writable.
+        :rtype: bool
         """
-        node.send_message()
+        done = node.send_message()
+        self.watch_writable(node, not done)
+        return done
 
     def send_out_buf_messages(self, only_register=False):
         """
         In this function, we will send hole out buffers to their own clients.
 
-        :return:
-        """
-        for node in self.nodes:
-            if node.is_register or (not only_register):
-                node.send_message()
+        Writes never block; A node that can not take everything keeps the rest in its out_buff and a node whose
+        connection failed is reported without stopping the other nodes.
 
-    def delete_buffer(self, length):
-        self._server_in_buf = self._server_in_buf[length:]
+        :return: Nodes whose connection was lost.
+        :rtype: list
+        """
+        self._flush_thread = threading.current_thread()
+        with self._dirty_nodes_lock:
+            dirty_nodes = self._dirty_nodes
+            self._dirty_nodes = set()
+            self._queued_bytes = 0
+            self._queued_packets = 0
+            self._flush_due.clear()
+        lost_nodes = []
+        pending_nodes = []
+        for node in dirty_nodes:
+            if not self.__contains(node):
+                continue
+            if only_register and not node.is_register:
+                pending_nodes.append(node)
+                continue
+            try:
+                if not self.send_messages_to_node(node):
+                    pending_nodes.append(node)
+            except LostConnection as lc:
+                lost_nodes.append(lc.node)
+        if pending_nodes:
+            with self._dirty_nodes_lock:
+                self._dirty_nodes.update(pending_nodes)
+        return lost_nodes
 
     def get_nodes(self):
         return self.nodes
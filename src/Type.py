@@ -4,4 +4,6 @@ class Type:
     join = '3'
     message = '4'
     reunion = '5'
+    fragment = '6'
+    batch = '7'
 
@@ -0,0 +1,16 @@
+import struct
+
+
+class Wire:
+    """
+    The start of every packet, shared by Packet and FrameDecoder; See Packet for the whole layout.
+    """
+    # Version, Type and Length fields.
+    prefix_size = 8
+    prefix_struct = struct.Struct(">hhi")
+    header_size = 20
+    # Protocol version 2: the compact header and binary bodies.
+    compact_version = 2
+    compact_header_size = 14
+    # Flags are kept in the high byte of the Version field.
+    version_mask = 0xff
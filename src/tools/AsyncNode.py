@@ -0,0 +1,99 @@
+import asyncio
+
+from src.tools.Node import Node, LostConnection
+
+
+class AsyncNode(Node):
+
+    def __init__(self, server_address, set_root=False, set_register=False):
+        """
+        The AsyncNode object constructor.
+
+        Same abstraction as Node, but the connection is an asyncio stream opened by 'open' on the running loop;
+        messages added before the connection is up stay in out_buff until it is.
+
+        :param server_address:
+        :param set_root:
+        :param set_register:
+        """
+        self.reader = None
+        self.writer = None
+        self.lost = False
+        Node.__init__(self, server_address, set_root=set_root, set_register=set_register)
+
+    def connect(self):
+        """
+        The connection is opened asynchronously by 'open'.
+
+        :return:
+        """
+        pass
+
+    async def open(self):
+        """
+        Opens the asyncio stream to the Node TCPServer address.
+
+        Warnings:
+            1. A failed connection is only reported by the next 'send_message' call as a LostConnection.
+
+        :return:
+        """
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.server_ip, self.server_port)
+        except OSError:
+            self.lost = True
+
+    def send_message(self):
+        """
+        Writes the buffered messages to the asyncio transport without waiting for them to drain; the transport
+        takes care of partial writes.
+
+        While the transport holds more than its high-water mark, the messages stay in out_buff, where our limits
+        apply to them; AsyncStream flushes us again when the transport has drained.
+
+        :return: Whether out_buff is empty now.
+        :rtype: bool
+        """
+        if self.lost or (self.writer is not None and self.writer.is_closing()):
+            raise LostConnection(self)
+        if self.writer is None:
+            return len(self.out_buff) == 0
+        if len(self.out_buff) == 0:
+            return True
+        if self.is_draining():
+            return False
+
+        parts = self.take_out_buff()
+        try:
+            self.writer.writelines(parts)
+        except:
+            raise LostConnection(self)
+        return True
+
+    def is_draining(self):
+        """
+
+        :return: Whether the transport holds more than its high-water mark; Wait for 'drain' before writing more.
+        :rtype: bool
+        """
+        transport = self.writer.transport
+        return transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]
+
+    async def drain(self):
+        """
+        Waits until the transport is below its low-water mark.
+
+        :return:
+        """
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.lost = True
+
+    def close(self):
+        """
+        Closing the asyncio stream.
+        :return:
+        """
+        if self.writer is not None:
+            self.writer.close()
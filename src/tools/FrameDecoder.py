@@ -0,0 +1,283 @@
+import struct
+
+from src.Type import Type
+from src.Wire import Wire
+
+
+class FrameDecoder:
+    """
+    Incremental framer for the byte stream of our TCPServer.
+
+    Received chunks are appended to one growable bytearray and a read offset marks where the next frame starts,
+    so draining N queued packets copies every byte only once instead of re-slicing the remaining buffer per packet.
+    Frames longer than max_frame_size are skipped as they arrive instead of being buffered, so the memory a connection
+    takes stays bounded, and Batch frames are unpacked into the packets they carry in the same pass; Only plain
+    Messages, which peers that do not send Fragments use for any size, may be up to max_message_frame_size long if
+    a larger one is given.
+    """
+    # Types of the frames which are handled apart; The prefix and header layout are in Wire.
+    _message_type = int(Type.message)
+    _batch_type = int(Type.batch)
+    # Type and body Length of a packet in a Batch.
+    _entry_struct = struct.Struct(">hi")
+    # Only frames up to batch_entry_size are packed into Batches of up to batch_size.
+    batch_entry_size = 1024
+    batch_size = 64 * 1024
+    # Large messages are sent as Fragments, which are far smaller than this.
+    max_frame_size = 1 << 20
+
+    def __init__(self, max_frame_size=None, max_message_frame_size=None):
+        """
+        Warnings:
+            1. Every connection may buffer a whole Message of up to max_message_frame_size bytes.
+
+        :param max_frame_size: Longest frame we keep; None means FrameDecoder.max_frame_size.
+        :param max_message_frame_size: Longest Message frame we keep, for the peers which send large messages in one
+                                       packet instead of as Fragments; None means max_frame_size.
+
+        :type max_frame_size: int
+        :type max_message_frame_size: int
+        """
+        self._buf = bytearray()
+        self._offset = 0
+        if max_frame_size is not None:
+            self.max_frame_size = max_frame_size
+        self.max_message_frame_size = self.max_frame_size if max_message_frame_size is None else max_message_frame_size
+        # Bytes of an oversized frame that have not arrived yet.
+        self._skip = 0
+
+    def feed(self, data):
+        """
+        Append a received chunk to the decoder.
+
+        :param data: Received data.
+        :type data: bytes | bytearray | memoryview
+
+        :return:
+        """
+        self._buf += data
+
+    def frames(self):
+        """
+        Cut every complete frame out of the buffer.
+
+        Warnings:
+            1. A frame with a Length field smaller than the fixed prefix can never complete; in that case the rest of
+               the buffer is discarded.
+
+        :return: All complete frames in arrival order.
+        :rtype: list
+        """
+        frames = []
+        buf = self._buf
+        end = len(buf)
+        offset = self._offset
+        with memoryview(buf) as view:
+            while end - offset >= Wire.prefix_size:
+                type, length = Wire.prefix_struct.unpack_from(view, offset)[1:]
+                if length < Wire.prefix_size:
+                    print("Warning: Invalid frame length, discarding", end - offset, "buffered bytes")
+                    offset = end
+                    break
+                if length > self.__max_length(type):
+                    offset += self.__skip_frame(type, length, end - offset)
+                    continue
+                if end - offset < length:
+                    break
+                FrameDecoder.__append_frame(frames, view[offset:offset + length])
+                offset += length
+        self._offset = offset
+        self.__compact()
+        return frames
+
+    def decode(self, data):
+        """
+        Feed a received chunk and return the frames it completes.
+
+        When nothing is buffered, complete frames are cut straight out of 'data' and only a trailing partial frame is
+        kept, so a chunk holding whole frames is copied once.
+
+        :param data: Received data.
+        :type data: bytes | bytearray | memoryview
+
+        :return: All complete frames in arrival order.
+        :rtype: list
+        """
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = memoryview(data)[skipped:]
+        if self.pending():
+            self.feed(data)
+            return self.frames()
+        frames = []
+        end = len(data)
+        offset = 0
+        with memoryview(data) as view:
+            while end - offset >= Wire.prefix_size:
+                type, length = Wire.prefix_struct.unpack_from(view, offset)[1:]
+                if length < Wire.prefix_size:
+                    print("Warning: Invalid frame length, discarding", end - offset, "received bytes")
+                    return frames
+                if length > self.__max_length(type):
+                    offset += self.__skip_frame(type, length, end - offset)
+                    continue
+                if end - offset < length:
+                    break
+                FrameDecoder.__append_frame(frames, view[offset:offset + length])
+                offset += length
+            if offset < end:
+                self.feed(view[offset:])
+        return frames
+
+    def __max_length(self, type):
+        if type == FrameDecoder._message_type:
+            return max(self.max_frame_size, self.max_message_frame_size)
+        return self.max_frame_size
+
+    def __skip_frame(self, type, length, available):
+        # Returns how many bytes of an oversized frame are at hand; the rest is dropped as it arrives.
+        print("Warning: Frame of", length, "bytes is larger than", self.__max_length(type), "bytes, skipping it")
+        self._skip = max(length - available, 0)
+        return min(length, available)
+
+    @staticmethod
+    def __header_size(version):
+        if version & Wire.version_mask == Wire.compact_version:
+            return Wire.compact_header_size
+        return Wire.header_size
+
+    @staticmethod
+    def __append_frame(frames, frame):
+        version, type, length = Wire.prefix_struct.unpack_from(frame, 0)
+        if type != FrameDecoder._batch_type:
+            frames.append(bytes(frame))
+            return
+        header_size = FrameDecoder.__header_size(version)
+        entry_size = FrameDecoder._entry_struct.size
+        offset = header_size
+        while offset < length:
+            if length - offset < entry_size:
+                print("Warning: Invalid Batch, discarding", length - offset, "bytes")
+                return
+            type, body_length = FrameDecoder._entry_struct.unpack_from(frame, offset)
+            offset += entry_size
+            if body_length < 0 or length - offset < body_length:
+                print("Warning: Invalid Batch, discarding", length - offset, "bytes")
+                return
+            packet = bytearray(header_size + body_length)
+            packet[:header_size] = frame[:header_size]
+            Wire.prefix_struct.pack_into(packet, 0, version, type, header_size + body_length)
+            packet[header_size:] = frame[offset:offset + body_length]
+            frames.append(packet)
+            offset += body_length
+
+    @staticmethod
+    def get_type(frame):
+        """
+
+        :param frame: An encoded packet.
+
+        :return: Type field of the packet, like Type.message; None if the frame is shorter than a prefix.
+        :rtype: str
+        """
+        if len(frame) < Wire.prefix_size:
+            return None
+        return str(Wire.prefix_struct.unpack_from(frame, 0)[1])
+
+    @staticmethod
+    def batch(frames, counts=None):
+        """
+        Packs every run of consecutive small frames with the same Version field and source server address into one
+        Batch frame; The order of the packets is kept.
+
+        :param frames: Encoded packets.
+        :param counts: If given, how many of the frames each returned frame carries is appended to it.
+
+        :type frames: list
+        :type counts: list
+
+        :return: The frames to send instead.
+        :rtype: list
+        """
+        batched = []
+        run = []
+        run_key = None
+        run_size = 0
+        for frame in frames:
+            key = FrameDecoder.__batch_key(frame)
+            if key is not None and key == run_key:
+                # The header of the packet is left out, but for its Type and Length.
+                size = len(frame) - (len(key) + 6) + FrameDecoder._entry_struct.size
+                if run_size + size <= FrameDecoder.batch_size:
+                    run.append(frame)
+                    run_size += size
+                    continue
+            FrameDecoder.__end_run(batched, run, run_size, counts)
+            if key is None:
+                batched.append(frame)
+                if counts is not None:
+                    counts.append(1)
+                run, run_key = [], None
+            else:
+                run, run_key, run_size = [frame], key, len(frame) + FrameDecoder._entry_struct.size
+        FrameDecoder.__end_run(batched, run, run_size, counts)
+        return batched
+
+    @staticmethod
+    def __batch_key(frame):
+        # Version field and source server address of a frame that may be put in a Batch.
+        if len(frame) > FrameDecoder.batch_entry_size:
+            return None
+        version, type = Wire.prefix_struct.unpack_from(frame, 0)[:2]
+        if type == FrameDecoder._batch_type:
+            return None
+        return bytes(frame[:2]) + bytes(frame[Wire.prefix_size:FrameDecoder.__header_size(version)])
+
+    @staticmethod
+    def __end_run(batched, run, size, counts):
+        if counts is not None and run:
+            counts.append(len(run))
+        if len(run) < 2:
+            batched.extend(run)
+            return
+        first = run[0]
+        version = Wire.prefix_struct.unpack_from(first, 0)[0]
+        header_size = FrameDecoder.__header_size(version)
+        buf = bytearray(size)
+        buf[:header_size] = first[:header_size]
+        Wire.prefix_struct.pack_into(buf, 0, version, FrameDecoder._batch_type, size)
+        offset = header_size
+        for frame in run:
+            type = Wire.prefix_struct.unpack_from(frame, 0)[1]
+            FrameDecoder._entry_struct.pack_into(buf, offset, type, len(frame) - header_size)
+            offset += FrameDecoder._entry_struct.size
+            buf[offset:offset + len(frame) - header_size] = frame[header_size:]
+            offset += len(frame) - header_size
+        batched.append(buf)
+
+    def pending(self):
+        """
+
+        :return: Number of buffered bytes that do not form a complete frame yet.
+        :rtype: int
+        """
+        return len(self._buf) - self._offset
+
+    def reset(self):
+        """
+        Discard any buffered data.
+
+        :return:
+        """
+        self._buf.clear()
+        self._offset = 0
+        self._skip = 0
+
+    def __compact(self):
+        if self._offset == len(self._buf):
+            self._buf.clear()
+            self._offset = 0
+        elif self._offset > len(self._buf) // 2:
+            del self._buf[:self._offset]
+            self._offset = 0
@@ -1,24 +1,39 @@
-import queue
+import heapq
+import itertools
+import threading
 import time
 import traceback
 
+from src.tools.SemiNode import SemiNode
+
 
 class GraphNode:
-    def __init__(self, address):
+    def __init__(self, address, capacity=2):
         """
         Our own understanding: port is the port which node is listening on
 
         :param address: (ip, port)
+        :param capacity: Maximum number of children.
         :type address: tuple
+        :type capacity: int
 
         """
         self.ip = address[0]
         self.port = address[1]
+        self.capacity = capacity
         self.parent = None
         self.children = []
         self.alive = False
         self.latest_reunion_time = None
         self.is_root = False
+        # Sequence numbers of the only valid entries of this node in the NetworkGraph expiry and parent heaps.
+        self.expiry_sequence = None
+        self.parent_sequence = None
+        # Cached values, kept up to date by set_parent, add_child and remove_from_parent.
+        self._depth = -1
+        self.subtree_size = 1
+        # Seconds a Reunion Hello may take per hop; Set by the NetworkGraph.
+        self.reunion_hop_time = 2.5
         pass
 
     def set_parent(self, parent):
@@ -27,8 +42,20 @@ class GraphNode:
         for child in self.children:
             child.alive = True
         self.latest_reunion_time = time.time() + 8
+        self.__update_subtree_depth()
         pass
 
+    def __update_subtree_depth(self):
+        if self.parent is None or self.parent.depth() == -1:
+            self._depth = -1
+        else:
+            self._depth = self.parent.depth() + 1
+        stack = list(self.children)
+        while stack:
+            node = stack.pop()
+            node._depth = -1 if node.parent.depth() == -1 else node.parent.depth() + 1
+            stack.extend(node.children)
+
     def set_address(self, new_address):
         self.ip = new_address[0]
         self.port = new_address[1]
@@ -44,8 +71,15 @@ class GraphNode:
 
     def add_child(self, child):
         self.children.append(child)
+        self.__add_to_subtree_size(child.subtree_size)
         pass
 
+    def __add_to_subtree_size(self, count):
+        node = self
+        while node is not None:
+            node.subtree_size += count
+            node = node.parent
+
     def set_alive(self):
         self.alive = True
         pass
@@ -55,14 +89,20 @@ class GraphNode:
         pass
 
     def get_subtree(self):
-        subtree = []
-        subtree += self.children
-        for child in self.children:
-            subtree += child.get_subtree()
-        return subtree
+        return list(self.iter_subtree())
+
+    def iter_subtree(self):
+        """
+        Iterates over every node in the sub-tree, without this node, in depth-first order.
+        """
+        stack = list(reversed(self.children))
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
 
     def is_full(self):
-        return len(self.children) >= 2
+        return len(self.children) >= self.capacity
 
     def is_available(self):
         return (not self.is_full()) and self.alive
@@ -70,9 +110,12 @@ class GraphNode:
     def remove_from_parent(self):
         if self.parent is not None:
             self.parent.remove_child(self)
+            self.parent = None
+            self.__update_subtree_depth()
 
     def remove_child(self, child):
         self.children.remove(child)
+        self.__add_to_subtree_size(-child.subtree_size)
 
     def print_summary(self):
         print("ip/port:", self.ip, "/", str(self.port), "alive:", self.alive)
@@ -85,10 +128,14 @@ class GraphNode:
             print(child.ip + "/" + str(child.port))
         print("last update:", self.latest_reunion_time)
         print("depth:", self.depth())
+        print("sub-tree size:", self.subtree_size)
 
     def update_latest_reunion_time(self):
         self.latest_reunion_time = time.time()
 
+    def expiry_deadline(self):
+        return self.latest_reunion_time + self.expiration_time()
+
     def is_expired(self):
         if self.is_root:
             return False
@@ -96,34 +143,66 @@ class GraphNode:
 
     def expiration_time(self):
         if self.depth() >= 0:
-            return self.depth() * 2.5 + 4
+            return self.depth() * self.reunion_hop_time + 4
         else:
-            return 2.5 * 8 + 4
+            return self.reunion_hop_time * 8 + 4
 
     def depth(self):
         if self.is_root:
             return 0
-        if self.parent is None:
-            return -1
-        if self.parent.depth() == -1:
-            return -1
-        return self.parent.depth() + 1
+        return self._depth
 
 
 class NetworkGraph:
-    def __init__(self, root):
+    def __init__(self, root, default_capacity=2, reunion_hop_time=2.5):
+        """
+        :param root: The root node.
+        :param default_capacity: Maximum number of children of the nodes which do not declare one.
+        :param reunion_hop_time: Seconds a Reunion Hello may take per hop before its sender is considered dead.
+
+        :type root: GraphNode
+        :type default_capacity: int
+        :type reunion_hop_time: float
+        """
         self.root = root
+        self.default_capacity = default_capacity
+        self.reunion_hop_time = reunion_hop_time
         root.alive = True
         root.is_root = True
         self.nodes = [root]
+        # Index of our nodes keyed by their normalized address.
+        self._nodes_by_address = {NetworkGraph.__key(root.ip, root.port): root}
+        # Min-heap of (deadline, sequence, node); Entries whose sequence is not the node expiry_sequence are stale.
+        self._expiry_heap = []
+        self._expiry_sequence = itertools.count()
+        # Guards the graph between the Peer threads and lets the reunion daemon sleep until the next deadline.
+        self._lock = threading.RLock()
+        self._expiry_changed = threading.Condition(self._lock)
+        # Called, with no arguments, whenever a node gets a deadline earlier than every other one.
+        self.expiry_listener = None
+        # Called with (node, new parent) whenever the sub-tree of an expired node is moved to a new parent; It is
+        # called once the graph is unlocked, so it may wait.
+        self.reattach_listener = None
+        # Whether the children of an expired node are reattached instead of dying with it.
+        self.reattach_orphans = True
+        # Min-heap of (depth, sequence, node) for nodes that may accept a new child; Stale entries are skipped lazily.
+        self._parent_heap = []
+        self._parent_sequence = itertools.count()
+        self.__index_parent(root)
+
+    @staticmethod
+    def __key(ip, port):
+        return SemiNode.parse_ip(ip), int(port)
 
     def find_parent(self, sender):
         """
         Here we should find a neighbour for the sender.
-        Best neighbour is the node who is nearest the root and has not more than one child.
+        Best neighbour is the node who is nearest the root and has not reached its capacity, so the tree stays as
+        shallow as the capacities allow.
 
-        Code design suggestion:
-            1. Do a BFS algorithm to find the target.
+        Instead of a BFS, available nodes are kept in a min-heap ordered by depth; Entries of nodes that became full,
+        dead or moved are dropped when they reach the top. Only a candidate deeper than the sender can be in its
+        sub-tree; The sub-tree is collected once, the first time such a candidate comes up.
 
         Warnings:
             1. Check whether there is sender node in our NetworkGraph or not; if exist do not return sender node or
@@ -136,33 +215,61 @@ class NetworkGraph:
         :rtype: GraphNode
         """
 
-        sender_node = self.find_node(sender[0], sender[1])
-        if sender_node is None:
-            return None
-        else:
-            bfs_queue = queue.Queue(-1)
-            bfs_queue.put(self.root)
-            while not bfs_queue.empty():
-                head = bfs_queue.get()
-                if head.is_available() and (sender_node.parent is not head):
-                    return head
-                for child in head.children:
-                    if child is not sender_node:
-                        bfs_queue.put(child)
-            return None
+        with self._lock:
+            sender_node = self.find_node(sender[0], sender[1])
+            if sender_node is None:
+                return None
+            sender_depth = sender_node.depth()
+            # The nodes in the heap are attached to the root, so a detached sub-tree holds none of them.
+            subtree = None if sender_depth >= 0 else ()
+            skipped = []
+            parent = None
+            while self._parent_heap:
+                entry = self._parent_heap[0]
+                if not NetworkGraph.__is_valid_parent(entry):
+                    heapq.heappop(self._parent_heap)
+                    continue
+                head = entry[2]
+                if subtree is None and entry[0] > sender_depth:
+                    subtree = set(sender_node.iter_subtree())
+                if head is sender_node or head is sender_node.parent or \
+                        (entry[0] > sender_depth and head in subtree):
+                    skipped.append(heapq.heappop(self._parent_heap))
+                    continue
+                parent = head
+                break
+            for entry in skipped:
+                heapq.heappush(self._parent_heap, entry)
+            return parent
+
+    def __index_parent(self, node):
+        if not node.is_available() or node.depth() < 0:
+            return
+        node.parent_sequence = next(self._parent_sequence)
+        heapq.heappush(self._parent_heap, (node.depth(), node.parent_sequence, node))
+        if len(self._parent_heap) > 2 * len(self.nodes) + 64:
+            self._parent_heap = [entry for entry in self._parent_heap if NetworkGraph.__is_valid_parent(entry)]
+            heapq.heapify(self._parent_heap)
+
+    @staticmethod
+    def __is_valid_parent(entry):
+        node = entry[2]
+        return node.parent_sequence == entry[1] and node.is_available() and node.depth() == entry[0]
 
     def find_node(self, ip, port):
-        for node in self.nodes:
-            if node.ip == ip and node.port == port:
-                return node
-        return None
+        node = self._nodes_by_address.get((ip, port))
+        if node is None:
+            node = self._nodes_by_address.get(NetworkGraph.__key(ip, port))
+        return node
 
     def turn_on_node(self, node_address):
-        node = self.find_node(node_address[0], node_address[1])
-        if node is None:
-            raise ValueError
-        else:
-            node.set_alive()
+        with self._lock:
+            node = self.find_node(node_address[0], node_address[1])
+            if node is None:
+                raise ValueError
+            else:
+                node.set_alive()
+                self.__index_parent(node)
         pass
 
     def turn_off_node(self, node_address):
@@ -173,30 +280,90 @@ class NetworkGraph:
             node.set_dead()
         pass
 
-    def remove_node(self, node_address):
+    def remove_node(self, node_address, reattach_children=False):
         """
         when a node becomes disabled that node becomes dead and removed from it's parent
         and all of its subtree nodes become dead too
+
+        With reattach_children, each direct child is moved with its whole sub-tree to a new parent instead; only the
+        children for which no parent is available die with their sub-tree.
+
         :param node_address:
-        :return:
+        :param reattach_children: Keep the sub-trees of the node alive under new parents.
+
+        :return: (child, new parent) of every reattached child.
+        :rtype: list
         """
+        with self._lock:
+            reattached = self.__remove_node(node_address, reattach_children)
+        self.__notify_reattached(reattached)
+        return reattached
+
+    def __remove_node(self, node_address, reattach_children):
         node = self.find_node(node_address[0], node_address[1])
         if node is None:
             raise ValueError
         else:
-            for child_node in node.get_subtree():
-                child_node.set_dead()
-
+            children = list(node.children)
+            if reattach_children:
+                # Detached sub-trees have no depth, so none of them is picked as a parent before it is moved.
+                for child_node in children:
+                    child_node.remove_from_parent()
+            else:
+                for child_node in node.iter_subtree():
+                    child_node.set_dead()
+
+            parent_node = node.parent
             node.remove_from_parent()
-            node.parent = None
             node.set_dead()
+            if parent_node is not None:
+                self.__index_parent(parent_node)
             # self.nodes.remove(node)
-        pass
 
-    def register_node(self, ip, port):
-        if self.find_node(ip, port) is None:
-            new_node = GraphNode((ip, port))
-            self.nodes.append(new_node)
+            reattached = []
+            if reattach_children:
+                for child_node in children:
+                    new_parent = self.__reattach(child_node)
+                    if new_parent is not None:
+                        reattached.append((child_node, new_parent))
+            return reattached
+
+    def __notify_reattached(self, reattached):
+        if self.reattach_listener is not None:
+            for node, new_parent in reattached:
+                self.reattach_listener(node, new_parent)
+
+    def __reattach(self, node):
+        new_parent = self.find_parent(node.get_address())
+        if new_parent is None:
+            node.set_dead()
+            for child_node in node.iter_subtree():
+                child_node.set_dead()
+            return None
+        # Reunion Hellos of the sub-tree are lost until the node joins its new parent; give them a full interval.
+        for child_node in node.iter_subtree():
+            child_node.update_latest_reunion_time()
+        self.assign_parent(node.ip, node.port, new_parent.get_address())
+        return new_parent
+
+    def register_node(self, ip, port, capacity=None):
+        """
+        :param ip: IP address of the new node.
+        :param port: Port of the new node.
+        :param capacity: Maximum number of children the node declared; None means the default_capacity.
+
+        :return:
+        """
+        with self._lock:
+            node = self.find_node(ip, port)
+            if node is None:
+                node = GraphNode((ip, port), self.default_capacity if capacity is None else capacity)
+                node.reunion_hop_time = self.reunion_hop_time
+                self.nodes.append(node)
+                self._nodes_by_address[NetworkGraph.__key(ip, port)] = node
+            elif capacity is not None and capacity != node.capacity:
+                node.capacity = capacity
+                self.__index_parent(node)
         pass
 
     def assign_parent(self, ip, port, father_address):
@@ -218,66 +385,175 @@ class NetworkGraph:
 
         :return:
         """
-        node = self.find_node(ip, port)
-        parent_node = self.find_node(father_address[0], father_address[1])
-
-        if node is None:
-            raise ValueError("Node is not registered")
-
-        if parent_node is None:
-            raise ValueError("Parent Node is not registered")
-
-        if node.parent is not None:
-            # TODO: we still don't know what to do in this case
-            node.remove_from_parent()
-            pass
-
-        # add to child
-        node.set_parent(parent_node)
-        # add to parent
-        parent_node.add_child(node)
+        with self._lock:
+            node = self.find_node(ip, port)
+            parent_node = self.find_node(father_address[0], father_address[1])
+
+            if node is None:
+                raise ValueError("Node is not registered")
+
+            if parent_node is None:
+                raise ValueError("Parent Node is not registered")
+
+            former_parent_node = node.parent
+            if node.parent is not None:
+                # TODO: we still don't know what to do in this case
+                node.remove_from_parent()
+                self.__index_parent(former_parent_node)
+                pass
+
+            # add to child
+            node.set_parent(parent_node)
+            # add to parent
+            parent_node.add_child(node)
+            # depth of the whole sub-tree may have changed
+            self.__schedule_expiry(node)
+            self.__index_parent(node)
+            for child_node in node.iter_subtree():
+                if child_node.alive:
+                    self.__schedule_expiry(child_node)
+                    self.__index_parent(child_node)
         pass
 
     def find_parent_and_assign(self, ip, port):
-        parent = self.find_parent((ip, port))
-        if parent is None:
-            return None
-        try:
-            self.assign_parent(ip, port, parent.get_address())
-        except ValueError as e:
-            print(repr(e), ip, "/", port)
-            traceback.print_exc()
-            return None
-        return parent.get_address()
+        with self._lock:
+            parent = self.find_parent((ip, port))
+            if parent is None:
+                return None
+            try:
+                self.assign_parent(ip, port, parent.get_address())
+            except ValueError as e:
+                print(repr(e), ip, "/", port)
+                traceback.print_exc()
+                return None
+            return parent.get_address()
 
     def print_all(self):
-        for node in self.nodes:
-            node.print_summary()
-            print("\n")
+        with self._lock:
+            for node in self.nodes:
+                node.print_summary()
+                print("\n")
 
     def is_registered(self, peer_address):
-        for node in self.nodes:
-            ip, port = node.get_address()
-            if ip == peer_address[0] and port == peer_address[1]:
-                return True
-        return False
-
-    def __get_all_expired_nodes(self):
-        result = []
-        for node in self.nodes:
-            if node.alive:
-                if node.is_expired():
-                    result.append(node)
-        return result
+        return self.find_node(peer_address[0], peer_address[1]) is not None
+
+    def get_subtree_parents(self, node_address):
+        """
+
+        :param node_address: Address of a node.
+        :type node_address: tuple
+
+        :return: (address, parent address, parent depth) of every node in the sub-tree of the node, without it.
+        :rtype: list
+        """
+        with self._lock:
+            node = self.find_node(node_address[0], node_address[1])
+            if node is None:
+                return []
+            return [(child.get_address(), child.parent.get_address(), child.parent.depth())
+                    for child in node.iter_subtree()]
+
+    def __schedule_expiry(self, node):
+        if node.is_root or node.latest_reunion_time is None:
+            return
+        deadline = node.expiry_deadline()
+        node.expiry_sequence = next(self._expiry_sequence)
+        earliest = self._expiry_heap[0][0] if self._expiry_heap else None
+        heapq.heappush(self._expiry_heap, (deadline, node.expiry_sequence, node))
+        if earliest is None or deadline < earliest:
+            self._expiry_changed.notify_all()
+            if self.expiry_listener is not None:
+                self.expiry_listener()
+        if len(self._expiry_heap) > 2 * len(self.nodes) + 64:
+            self._expiry_heap = [entry for entry in self._expiry_heap if NetworkGraph.__is_valid_expiry(entry)]
+            heapq.heapify(self._expiry_heap)
+
+    @staticmethod
+    def __is_valid_expiry(entry):
+        node = entry[2]
+        return node.alive and node.expiry_sequence == entry[1]
+
+    def __pop_expired_node(self, now):
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            entry = heapq.heappop(self._expiry_heap)
+            if not NetworkGraph.__is_valid_expiry(entry):
+                continue
+            node = entry[2]
+            if node.is_expired():
+                return node
+            # Its depth has changed since it was scheduled.
+            self.__schedule_expiry(node)
+        return None
 
     def remove_all_expired_nodes(self):
-        for node in self.__get_all_expired_nodes():
-            print("Time: ", time.time(), "Last:", node.latest_reunion_time, "Expire:", node.expiration_time(), "Removing Node: ", node.get_address())
-            self.remove_node(node.get_address())
+        """
+        Turns off every node whose Reunion Hello is overdue.
+
+        Only the nodes whose deadline has passed are visited; the others wait in a min-heap ordered by deadline.
+        If reattach_orphans is set, the children of every removed node are moved to new parents with their sub-trees.
+
+        :return: Seconds until the next deadline, or None if no node can expire.
+        :rtype: float
+        """
+        reattached = []
+        with self._lock:
+            now = time.time()
+            node = self.__pop_expired_node(now)
+            while node is not None:
+                print("Time: ", time.time(), "Last:", node.latest_reunion_time, "Expire:", node.expiration_time(), "Removing Node: ", node.get_address())
+                reattached.extend(self.__remove_node(node.get_address(), self.reattach_orphans))
+                node = self.__pop_expired_node(now)
+            next_expiry = self.__time_to_next_expiry(now)
+            # A child may have been moved again, or have died, when a later node of this pass expired.
+            reattached = [(node, parent) for node, parent in reattached if node.alive and node.parent is parent]
+        self.__notify_reattached(reattached)
+        return next_expiry
+
+    def __time_to_next_expiry(self, now):
+        while self._expiry_heap and not NetworkGraph.__is_valid_expiry(self._expiry_heap[0]):
+            heapq.heappop(self._expiry_heap)
+        if not self._expiry_heap:
+            return None
+        return max(self._expiry_heap[0][0] - now, 0)
+
+    def wait_for_expiry(self, timeout=None):
+        """
+        Sleeps until the next deadline, or until a node gets a deadline earlier than every other one.
+
+        :param timeout: Maximum seconds to sleep; None means no limit.
+
+        :return:
+        """
+        with self._lock:
+            next_expiry = self.__time_to_next_expiry(time.time())
+            if next_expiry is None or (timeout is not None and timeout < next_expiry):
+                next_expiry = timeout
+            if next_expiry is None or next_expiry > 0:
+                self._expiry_changed.wait(next_expiry)
 
     def update_latest_reunion_time(self, peer_address):
-        node = self.find_node(peer_address[0], peer_address[1])
-        node.update_latest_reunion_time()
+        with self._lock:
+            node = self.find_node(peer_address[0], peer_address[1])
+            node.update_latest_reunion_time()
+            if node.alive:
+                self.__schedule_expiry(node)
+
+    def update_latest_reunion_times(self, peer_addresses):
+        """
+        update_latest_reunion_time for all the addresses of an Aggregated Reunion Hello at once.
+
+        :param peer_addresses: Addresses of the nodes that are alive; The ones which are not registered are skipped.
+
+        :return:
+        """
+        with self._lock:
+            for peer_address in peer_addresses:
+                node = self.find_node(peer_address[0], peer_address[1])
+                if node is None:
+                    continue
+                node.update_latest_reunion_time()
+                if node.alive:
+                    self.__schedule_expiry(node)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,8 @@
-import copy
+from collections import deque
+import threading
 
+from src.tools.FrameDecoder import FrameDecoder
+from src.tools.OutBuffLimits import QueuePolicy
 from src.tools.simpletcp.clientsocket import ClientSocket
 
 
@@ -10,8 +13,15 @@ class LostConnection(Exception):
 
 class Node:
     message_size = 2048
+    # Most systems refuse more buffers than this (IOV_MAX) in one sendmsg call.
+    max_write_buffers = 1024
+    # Whether the peer behind this node told us it accepts compressed packets and Batch frames.
+    accepts_compression = False
+    accepts_batches = False
+    # The OutBuffLimits of our out_buff; None means it is not limited.
+    limits = None
 
-    def __init__(self, server_address, set_root=False, set_register=False):
+    def __init__(self, server_address, set_root=False, set_register=False, expect_acks=False):
         """
         The Node object constructor.
 
@@ -25,50 +35,239 @@ class Node:
         :param server_address:
         :param set_root:
         :param set_register:
+        :param expect_acks: Whether the Node TCPServer acknowledges what we send (see confirm_delivery).
         """
         self.is_register = set_register
+        self.expect_acks = expect_acks
         self.is_root = set_root
         self.server_ip = Node.parse_ip(server_address[0])
         self.server_port = int(server_address[1])
-        try:
-            self.socket = ClientSocket(self.server_ip, self.server_port, single_use=False)
-        except:
-            raise LostConnection(self)
+        self.out_buff = deque()
+        # Whether the head of out_buff is the rest of a partly written message.
+        self.partial_head = False
+        # Bytes in out_buff; out_buff is shared between threads, so it is only touched while holding out_buff_lock.
+        self.out_bytes = 0
+        self.out_buff_lock = threading.Condition()
+        self.dropped_packets = 0
+        # Called with the node and True when out_buff fills up to the high watermark of our limits, and with False
+        # when it drains to the low watermark again.
+        self.watermark_listener = None
+        self.above_high_watermark = False
+        self.socket = None
+        self.connect()
 
         # print("New Node Server Address: ", server_address)
 
-        self.out_buff = []
+    def connect(self):
+        """
+        Connects our ClientSocket to the Node TCPServer address.
+
+        :return:
+        """
+        try:
+            self.socket = ClientSocket(self.server_ip, self.server_port, single_use=False, pipelined=True,
+                                       acks=self.expect_acks)
+        except:
+            raise LostConnection(self)
 
     def send_message(self):
         """
         Final function to send buffer to the client's socket.
 
-        :return:
+        Writes as much of out_buff as the socket accepts without blocking, handing the buffered messages to one
+        scatter/gather call instead of joining them; A partially written message stays at the head of out_buff and the
+        rest is written when the socket becomes writable again.
+
+        :return: Whether out_buff is empty now.
+        :rtype: bool
+        """
+        with self.out_buff_lock:
+            try:
+                done = self.__write_out_buff()
+            finally:
+                crossed = self.__check_watermarks()
+                self.out_buff_lock.notify_all()
+        self.__report_watermark(crossed)
+        return done
+
+    def __write_out_buff(self):
+        while len(self.out_buff) > 0:
+            parts, counts = self.__next_write_parts()
+            try:
+                sent = self.socket.sendmsg_nowait(parts)
+            except:
+                raise LostConnection(self)
+            for part, count in zip(parts, counts):
+                if sent < len(part):
+                    if sent > 0:
+                        self.__pop_written(count)
+                        self.out_buff.appendleft(memoryview(part)[sent:])
+                        self.partial_head = True
+                        self.out_bytes += len(part) - sent
+                    return False
+                sent -= len(part)
+                self.__pop_written(count)
+        return True
+
+    def __next_write_parts(self):
+        # The messages at the head of out_buff, packed into Batches if the peer accepts them, and how many messages
+        # each part carries; out_buff itself keeps single messages, so our limits can still drop any of them.
+        if len(self.out_buff) <= Node.max_write_buffers:
+            messages = list(self.out_buff)
+        else:
+            messages = [self.out_buff[i] for i in range(Node.max_write_buffers)]
+        if not self.accepts_batches or len(messages) < 2:
+            return messages, [1] * len(messages)
+        head = [messages.pop(0)] if self.partial_head else []
+        counts = [1] * len(head)
+        return head + FrameDecoder.batch(messages, counts), counts
+
+    def __pop_written(self, count):
+        for _ in range(count):
+            self.out_bytes -= len(self.out_buff.popleft())
+        self.partial_head = False
+
+    def take_out_buff(self):
+        """
+        Empties out_buff, e.g. to hand everything to a transport that writes on its own.
+
+        :return: The messages that were in out_buff, packed into Batches if the peer accepts them.
+        :rtype: deque
+        """
+        with self.out_buff_lock:
+            messages = self.out_buff
+            self.out_buff = deque()
+            self.out_bytes = 0
+            partial_head, self.partial_head = self.partial_head, False
+            crossed = self.__check_watermarks()
+            self.out_buff_lock.notify_all()
+        self.__report_watermark(crossed)
+        if self.accepts_batches and len(messages) > 1:
+            head = [messages.popleft()] if partial_head else []
+            messages = deque(head + FrameDecoder.batch(messages))
+        return messages
+
+    def __check_watermarks(self):
+        # Returns True or False if out_buff just crossed the high or the low watermark, and None otherwise.
+        limits = self.limits
+        if limits is None:
+            return None
+        if not self.above_high_watermark and \
+                limits.above(limits.high_watermark, self.out_bytes, len(self.out_buff)):
+            self.above_high_watermark = True
+            return True
+        if self.above_high_watermark and \
+                not limits.above(limits.low_watermark, self.out_bytes, len(self.out_buff)):
+            self.above_high_watermark = False
+            return False
+        return None
+
+    def __report_watermark(self, crossed):
+        if crossed is not None and self.watermark_listener is not None:
+            self.watermark_listener(self, crossed)
+
+    def has_message(self):
+        """
+
+        :return: Whether there is something left in out_buff.
+        :rtype: bool
+        """
+        return len(self.out_buff) > 0
+
+    def fileno(self):
+        """
+
+        :return: File descriptor of our ClientSocket, for selectors.
+        :rtype: int
+        """
+        return self.socket.fileno()
+
+    def confirm_delivery(self, timeout=None):
+        """
+        Waits until the node's TCPServer has acknowledged everything we have sent to it.
+
+        Warnings:
+            1. Writes never wait for acknowledgements; this only works if the other Stream sends them (send_acks), and
+               then the Node should be made with expect_acks, so they are read as we write.
+
+        :param timeout: Maximum seconds to wait.
+
+        :return: Whether everything was acknowledged in time.
+        :rtype: bool
         """
-        if len(self.out_buff) == 0:
-            return
-
-        parts = copy.copy(self.out_buff)
-        message = b''
-        for part in parts:
-            if type(part) == bytes:
-                message += part
-            elif type(part) == str:
-                message += bytes(part, "UTF-8")
-        self.out_buff = []
         try:
-            self.socket.send(message)
+            return self.socket.wait_for_ack(timeout)
         except:
             raise LostConnection(self)
 
-    def add_message_to_out_buff(self, message):
+    def add_message_to_out_buff(self, message, may_block=False):
         """
         Here we will add a new message to the server out_buff, then in 'send_message' will send them.
 
+        If out_buff has limits and the message does not fit, the QueuePolicy of its packet type decides what happens.
+
+        Warnings:
+            1. Never let the thread which calls 'send_message' block; it would wait for itself.
+
         :param message: The message we want to add to out_buff
-        :return:
+        :param may_block: Whether we may wait for room if the policy of the message says so.
+
+        :return: Whether the message was added; False if it was dropped.
+        :rtype: bool
+        """
+        if type(message) == str:
+            message = bytes(message, "UTF-8")
+        with self.out_buff_lock:
+            if self.limits is not None and not self.__make_room(message, may_block):
+                self.dropped_packets += 1
+                return False
+            self.out_buff.append(message)
+            self.out_bytes += len(message)
+            crossed = self.__check_watermarks()
+        self.__report_watermark(crossed)
+        return True
+
+    def __fits(self, size):
+        # An empty out_buff takes any message, or a message larger than the limit could never be sent.
+        return len(self.out_buff) == 0 or self.limits.fits(self.out_bytes + size, len(self.out_buff) + 1)
+
+    def __make_room(self, message, may_block):
+        size = len(message)
+        if self.__fits(size):
+            return True
+        policy = self.limits.get_policy(FrameDecoder.get_type(message))
+        if policy == QueuePolicy.never_drop:
+            return True
+        if policy == QueuePolicy.block and may_block:
+            return self.out_buff_lock.wait_for(lambda: self.__fits(size), self.limits.block_timeout)
+        if policy == QueuePolicy.drop_oldest:
+            self.__drop_oldest(size)
+            return self.__fits(size)
+        return False
+
+    def __drop_oldest(self, size):
+        # Drops the oldest messages whose type may be dropped so, until a message of 'size' bytes fits.
+        kept = deque()
+        if self.partial_head:
+            kept.append(self.out_buff.popleft())
+        while self.out_buff and not self.limits.fits(self.out_bytes + size, len(kept) + len(self.out_buff) + 1):
+            message = self.out_buff.popleft()
+            if self.limits.get_policy(FrameDecoder.get_type(message)) == QueuePolicy.drop_oldest:
+                self.out_bytes -= len(message)
+                self.dropped_packets += 1
+            else:
+                kept.append(message)
+        kept.extend(self.out_buff)
+        self.out_buff = kept
+
+    def get_out_buff_size(self):
+        """
+
+        :return: (bytes, packets) waiting in out_buff.
+        :rtype: tuple
         """
-        self.out_buff.append(message)
+        with self.out_buff_lock:
+            return self.out_bytes, len(self.out_buff)
 
     def close(self):
         """
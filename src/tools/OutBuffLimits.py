@@ -0,0 +1,92 @@
+from src.Type import Type
+
+
+class QueuePolicy:
+    """
+    What happens to a packet that does not fit into the out_buff of a Node.
+    """
+    # Wait up to OutBuffLimits.block_timeout for room, then drop the packet; Only producers outside the thread which
+    # flushes the Stream wait, the others drop it at once.
+    block = 'block'
+    # Make room by dropping the oldest unsent packets of types with this policy; Drop the packet if that is not enough.
+    drop_oldest = 'drop_oldest'
+    # Drop the packet.
+    drop_new = 'drop_new'
+    # Queue the packet even over the limits.
+    never_drop = 'never_drop'
+
+
+class OutBuffLimits:
+    default_policies = {
+        Type.register: QueuePolicy.never_drop,
+        Type.advertise: QueuePolicy.never_drop,
+        Type.join: QueuePolicy.never_drop,
+        Type.message: QueuePolicy.drop_oldest,
+        Type.reunion: QueuePolicy.never_drop,
+        # A dropped Fragment makes the rest of its message useless to the neighbour; Dropping the new one tells the Peer
+        # which message that was, so it stops sending the rest.
+        Type.fragment: QueuePolicy.drop_new,
+    }
+
+    def __init__(self, max_bytes=None, max_packets=None, policies=None, default_policy=QueuePolicy.drop_new,
+                 block_timeout=1.0, high_watermark=0.8, low_watermark=0.5):
+        """
+        The OutBuffLimits object constructor.
+
+        One object is shared by every Node of a Stream; Each Node applies the limits to its own out_buff.
+
+        :param max_bytes: Most bytes waiting in one out_buff; None means no limit.
+        :param max_packets: Most packets waiting in one out_buff; None means no limit.
+        :param policies: QueuePolicy of every packet type, e.g. {Type.message: QueuePolicy.block}; The types left out
+                         keep their default_policies.
+        :param default_policy: QueuePolicy of the types no policy is given for.
+        :param block_timeout: Most seconds a producer waits with QueuePolicy.block.
+        :param high_watermark: Fraction of the limits at which the out_buff is reported as filling up.
+        :param low_watermark: Fraction of the limits at which a filled up out_buff is reported as drained again.
+
+        :type max_bytes: int
+        :type max_packets: int
+        :type policies: dict
+        :type default_policy: str
+        :type block_timeout: float
+        :type high_watermark: float
+        :type low_watermark: float
+        """
+        self.max_bytes = max_bytes
+        self.max_packets = max_packets
+        self.policies = dict(OutBuffLimits.default_policies)
+        if policies is not None:
+            self.policies.update(policies)
+        self.default_policy = default_policy
+        self.block_timeout = block_timeout
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+
+    def get_policy(self, type):
+        """
+
+        :param type: Packet type, e.g. Type.message.
+        :type type: str
+
+        :return: The QueuePolicy of the type.
+        :rtype: str
+        """
+        return self.policies.get(type, self.default_policy)
+
+    def fits(self, out_bytes, out_packets):
+        """
+
+        :return: Whether an out_buff with this many bytes and packets is within the limits.
+        :rtype: bool
+        """
+        return (self.max_bytes is None or out_bytes <= self.max_bytes) and \
+               (self.max_packets is None or out_packets <= self.max_packets)
+
+    def above(self, fraction, out_bytes, out_packets):
+        """
+
+        :return: Whether an out_buff with this many bytes and packets is above the fraction of any limit.
+        :rtype: bool
+        """
+        return (self.max_bytes is not None and out_bytes > fraction * self.max_bytes) or \
+               (self.max_packets is not None and out_packets > fraction * self.max_packets)
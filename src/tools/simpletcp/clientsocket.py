@@ -1,9 +1,16 @@
+import select
+import struct
 import sys
 import socket
+import time
 
 
 class ClientSocket:
-    def __init__(self, mode, port, received_bytes=2048, single_use=True):
+    # A cumulative acknowledgement is 'ACK' followed by the total number of
+    # bytes the server has received on this connection.
+    ack_struct = struct.Struct(">3sQ")
+
+    def __init__(self, mode, port, received_bytes=2048, single_use=True, pipelined=False, acks=False):
         """
 
         Handle the socket's mode.
@@ -12,6 +19,13 @@ class ClientSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+
+        A pipelined socket never waits for a response after a write; writes
+        stream back to back and delivery can be confirmed later, on demand,
+        with wait_for_ack if the server sends cumulative acknowledgements.
+        Set acks if it does: every pipelined write then first reads the
+        acknowledgements that have arrived, so they never pile up; otherwise
+        writes read nothing.
         """
 
         if mode == "localhost":
@@ -31,11 +45,25 @@ class ClientSocket:
         self.received_bytes = received_bytes
         # Save whether this socket is single-use or not.
         self.single_use = single_use
+        # Save whether writes wait for a response or not.
+        self.pipelined = pipelined
+        # Save whether the server acknowledges what we write.
+        self.acks = acks
+        if self.pipelined and self.single_use:
+            print("a pipelined socket can not be single-use", file=sys.stderr)
+            raise ValueError
+        # Keep track of cumulative acknowledgements in pipelined mode.
+        self.sent_bytes = 0
+        self.acked_bytes = 0
+        self._ack_buf = b''
         # If this isn't a single-use socket, connect right away.
         if not self.single_use:
             self._socket.connect((self.connect_ip, self.connect_port))
             # Keep track of whether this socket has been closed.
             self.closed = False
+            # Pipelined writes never block.
+            if self.pipelined:
+                self._socket.setblocking(False)
         # Keep track of whether this socket has been used, so we can
         # warn single-use sockets not to send data twice.
         self.used = False
@@ -59,7 +87,8 @@ class ClientSocket:
         This method returns a string which is the response received
         from the server at the address specified in this object's
         constructor.
-        It is "" if no response was received.
+        It is "" if no response was received, and always b"" for a
+        pipelined socket, which does not wait for one.
 
         If the socket is single-use, we need to connect now
         and then immediately close after our correspondence with
@@ -84,6 +113,15 @@ class ClientSocket:
         if type(data) != bytes:
             print("data must be a string or bytes", file=sys.stderr)
             raise ValueError
+        if self.pipelined:
+            # Write everything, only waiting while the socket buffer is full.
+            view = memoryview(data)
+            while view:
+                sent = self.send_nowait(view)
+                view = view[sent:]
+                if view:
+                    select.select([], [self._socket], [])
+            return b''
         # Everything is setup, now we must send the data.
         self._socket.send(data)
         # Keep track of the fact that we've sent data (or attempted to).
@@ -98,6 +136,91 @@ class ClientSocket:
         # Return the response
         return response
 
+    def wait_for_ack(self, timeout=None):
+        """
+
+        Block until the server has acknowledged every byte written so far.
+        Only meaningful for pipelined sockets talking to a server that sends
+        cumulative acknowledgements.
+
+        Returns True if everything was acknowledged before the timeout.
+
+        """
+        if not self.pipelined:
+            print("only pipelined sockets track acknowledgements", file=sys.stderr)
+            raise RuntimeError
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.acked_bytes < self.sent_bytes:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            readable, _, _ = select.select([self._socket], [], [], remaining)
+            if readable:
+                self._read_acks()
+        return True
+
+    def send_nowait(self, data):
+        """
+
+        Write as much of data as the socket accepts right now and return
+        the number of bytes written; 0 means the socket buffer is full.
+        Only available for pipelined sockets.
+
+        """
+        if not self.pipelined:
+            print("only pipelined sockets can write without waiting", file=sys.stderr)
+            raise RuntimeError
+        # Don't let unread acknowledgements pile up, but never wait for one.
+        if self.acks:
+            self._read_acks()
+        try:
+            sent = self._socket.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        self.sent_bytes += sent
+        return sent
+
+    def sendmsg_nowait(self, buffers):
+        """
+
+        Like send_nowait, but writes a list of buffers with a single
+        scatter/gather call instead of joining them first.
+
+        """
+        if not self.pipelined:
+            print("only pipelined sockets can write without waiting", file=sys.stderr)
+            raise RuntimeError
+        if not hasattr(self._socket, "sendmsg"):
+            # No scatter/gather on this platform.
+            return self.send_nowait(b''.join(buffers))
+        if self.acks:
+            self._read_acks()
+        try:
+            sent = self._socket.sendmsg(buffers)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        self.sent_bytes += sent
+        return sent
+
+    def fileno(self):
+        # Lets selectors watch this socket.
+        return self._socket.fileno()
+
+    def _read_acks(self):
+        # Pipelined sockets are non-blocking, so this never waits.
+        try:
+            data = self._socket.recv(self.received_bytes)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            # The server closed the connection.
+            raise ConnectionResetError
+        self._ack_buf += data
+        size = ClientSocket.ack_struct.size
+        while len(self._ack_buf) >= size:
+            self.acked_bytes = ClientSocket.ack_struct.unpack_from(self._ack_buf)[1]
+            self._ack_buf = self._ack_buf[size:]
+
     def close(self):
         # If the connection isn't already closed, close it.
         if not self.closed:
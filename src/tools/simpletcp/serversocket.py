@@ -1,13 +1,13 @@
 import errno
 import queue
-import select
+import selectors
 import socket
 import sys
 
 
 class ServerSocket:
 
-    def __init__(self, mode, port, read_callback, max_connections, received_bytes):
+    def __init__(self, mode, port, read_callback, max_connections, received_bytes, close_callback=None):
         """
         Handle the socket's mode.
         The socket's mode determines the IP address it binds to.
@@ -35,9 +35,11 @@ class ServerSocket:
         self._socket.setblocking(0)
         # Bind the socket, so it can listen.
         self._socket.bind((self.ip, self.port))
-        # Save the callback
+        # Save the callbacks
         self.callback = read_callback
-        # Save the number of maximum connections.
+        self.close_callback = close_callback
+        # Save the accept backlog (the number of pending connections the
+        # kernel queues for us).
         self._max_connections = max_connections
         if type(self._max_connections) != int:
             print("max_connections must be an int", file=sys.stderr)
@@ -45,85 +47,121 @@ class ServerSocket:
         # Save the number of bytes to be received each time we read from
         # a socket
         self.received_bytes = received_bytes
-
-    def run(self):
-        # Start listening
-        self._socket.listen(self._max_connections)
-        # Create a list of readers (sockets that will be read from) and a list
-        # of writers (sockets that will be written to).
-        readers = [self._socket]
-        writers = []
+        # The selector (epoll on Linux) that watches every socket.
+        self._selector = selectors.DefaultSelector()
         # Create a dictionary of queue.Queues for data to be sent.
         # This dictionary maps sockets to queue.Queue objects
-        queues = dict()
+        self._queues = dict()
+        # Data taken from a queue that the socket did not accept completely.
+        # This dictionary maps sockets to the unsent bytes.
+        self._pending = dict()
         # Create a similar dictionary that stores IP addresses.
         # This dictionary maps sockets to IP addresses
-        IPs = dict()
+        self._IPs = dict()
+        # Every connection gets its own preallocated receive buffer that
+        # recv_into fills in place.
+        # This dictionary maps sockets to memoryviews over those buffers.
+        self._buffers = dict()
+
+    def run(self):
+        # Start listening
+        self._socket.listen(self._max_connections)
+        self._selector.register(self._socket, selectors.EVENT_READ)
         # Now, the main loop.
-        while readers:
+        while True:
             # Block until a socket is ready for processing.
-            read, write, err = select.select(readers, writers, readers)
-            # Deal with sockets that need to be read from.
-            for sock in read:
+            for key, events in self._selector.select():
+                sock = key.fileobj
                 if sock is self._socket:
-                    # We have a viable connection!
-                    client_socket, client_ip = self._socket.accept()
-                    # Make it a non-blocking connection.
-                    client_socket.setblocking(0)
-                    # Add it to our readers.
-                    readers.append(client_socket)
-                    # Make a queue for it.
-                    queues[client_socket] = queue.Queue()
-                    # Store its IP address.
-                    IPs[client_socket] = client_ip
+                    self._accept()
+                    continue
+                if events & selectors.EVENT_READ:
+                    self._read(sock)
+                if events & selectors.EVENT_WRITE and sock in self._queues:
+                    self._write(sock)
+
+    def _accept(self):
+        # Take every waiting connection; we are only told once that the
+        # listening socket became readable.
+        while True:
+            try:
+                client_socket, client_ip = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            # Make it a non-blocking connection.
+            client_socket.setblocking(0)
+            # Make a queue for it.
+            self._queues[client_socket] = queue.Queue()
+            # Store its IP address.
+            self._IPs[client_socket] = client_ip
+            # Allocate its receive buffer.
+            self._buffers[client_socket] = memoryview(bytearray(self.received_bytes))
+            # Start reading from it.
+            self._selector.register(client_socket, selectors.EVENT_READ)
+
+    def _read(self, sock):
+        # Someone sent us something! Receive until the socket runs dry, so a
+        # single readiness notification is enough (edge-triggered style).
+        buffer = self._buffers[sock]
+        while True:
+            try:
+                received = sock.recv_into(buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as e:
+                if e.errno == errno.ECONNRESET:
+                    # Consider 'Connection reset by peer'
+                    # the same as reading zero bytes
+                    received = 0
                 else:
-                    # Someone sent us something! Let's receive it.
-                    try:
-                        data = sock.recv(self.received_bytes)
-                    except socket.error as e:
-                        if e.errno is errno.ECONNRESET:
-                            # Consider 'Connection reset by peer'
-                            # the same as reading zero bytes
-                            data = None
-                        else:
-                            raise e
-                    if data:
-                        # Call the callback
-                        self.callback(IPs[sock], queues[sock], data)
-                        # Put the client socket in writers so we can write to it
-                        # later.
-                        if sock not in writers:
-                            writers.append(sock)
-                    else:
-                        # We received zero bytes, so we should close the stream
-                        # Stop writing to it.
-                        if sock in writers:
-                            writers.remove(sock)
-                        # Stop reading from it.
-                        readers.remove(sock)
-                        # Close the connection.
-                        sock.close()
-                        # Destroy is queue
-                        del queues[sock]
-            # Deal with sockets that need to be written to.
-            for sock in write:
+                    raise e
+            if not received:
+                # We received zero bytes, so we should close the stream
+                self._close(sock)
+                return
+            # Call the callback; the data is only valid until
+            # the next read from this socket.
+            self.callback(self._IPs[sock], self._queues[sock], buffer[:received])
+            # If the callback queued a response, wait until we can write it.
+            if not self._queues[sock].empty():
+                self._selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            if received < len(buffer):
+                return
+
+    def _write(self, sock):
+        data_queue = self._queues[sock]
+        while True:
+            data = self._pending.pop(sock, None)
+            if data is None:
                 try:
                     # Get the next chunk of data in the queue, but don't wait.
-                    data = queues[sock].get_nowait()
+                    data = data_queue.get_nowait()
                 except queue.Empty:
                     # The queue is empty -> nothing needs to be written.
-                    writers.remove(sock)
-                else:
-                    # The queue wasn't empty; we did, in fact, get something.
-                    # So send it.
-                    sock.send(data)
-            # Deal with errors in sockets.
-            for sock in err:
-                # Remove the socket from every list.
-                readers.remove(sock)
-                if sock in writers:
-                    writers.remove(sock)
-                # Close the connection.
-                sock.close()
-                # Destroy its queue.
-                del queues[sock]
+                    self._selector.modify(sock, selectors.EVENT_READ)
+                    return
+            try:
+                sent = sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except socket.error:
+                self._close(sock)
+                return
+            if sent < len(data):
+                # Keep the rest for the next time the socket is writable.
+                self._pending[sock] = data[sent:]
+                return
+
+    def _close(self, sock):
+        # Stop watching it.
+        self._selector.unregister(sock)
+        # Close the connection.
+        sock.close()
+        # Destroy its queue and receive buffer.
+        del self._queues[sock]
+        del self._buffers[sock]
+        self._pending.pop(sock, None)
+        # Let the owner forget anything it kept for this connection.
+        address = self._IPs.pop(sock)
+        if self.close_callback is not None:
+            self.close_callback(address)
@@ -1,3 +1,5 @@
+import socket
+
 from src.tools.simpletcp.serversocket import ServerSocket
 
 
@@ -9,20 +11,23 @@ class TCPServer:
      public ->    (0.0.0.0)
      otherwise, mode is interpreted as an IP address.
      port specifies the port that the server socket binds to.
+     maximum_connections is the accept backlog of the listening socket.
      read_callback specifies the function that is called when the server reads incoming data.
      read_callback must be a function that takes three arguments:
      The first argument must be a string which represents the IP
      address that data was received from.
      The second argument must be a queue (a queue.Queue()) which
      is a tunnel of data to send to the socket that it received from.
-     The third argument must be data, which is a string of bytes
-     that the server received.
+     The third argument must be data, which is a memoryview over the
+     bytes that the server received; it is only valid during the call.
+     close_callback, if given, is called with the IP address of a
+     connection when that connection is closed.
     """
 
     def __init__(self, mode, port, read_callback,
-                 maximum_connections=5, receive_bytes=2048):
+                 maximum_connections=socket.SOMAXCONN, receive_bytes=2048, close_callback=None):
         self.server_socket = ServerSocket(
-            mode, port, read_callback, maximum_connections, receive_bytes
+            mode, port, read_callback, maximum_connections, receive_bytes, close_callback
         )
 
     def run(self):
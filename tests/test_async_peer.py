@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+
+from src.AsyncPeer import AsyncPeer
+from tests.test_peer import IP, LARGE_MESSAGE, free_port
+
+
+async def wait_until(condition, timeout=10):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+class TestAsyncPeerLoopback(unittest.TestCase):
+    def test_messages_between_two_peers(self):
+        asyncio.run(self.exchange_messages())
+
+    async def exchange_messages(self):
+        root_port = free_port()
+        root = AsyncPeer(IP, root_port, is_root=True, flush_delay=0.01)
+        received = asyncio.Queue()
+        root.message_listener = lambda payload, sender: received.put_nowait((bytes(payload), sender))
+        peers = [root]
+        tasks = [asyncio.ensure_future(root.run_async())]
+        try:
+            # The client connects to the root as soon as it starts.
+            self.assertTrue(await wait_until(lambda: root.stream.server))
+            client = AsyncPeer(IP, free_port(), root_address=(IP, root_port), flush_delay=0.01)
+            peers.append(client)
+            tasks.append(asyncio.ensure_future(client.run_async()))
+            self.assertTrue(await wait_until(lambda: client.stream.server))
+            client.register()
+            client.advertise()
+            self.assertTrue(await wait_until(lambda: client.is_alive))
+            client.send_message(b'\x00hello\xff')
+            client.send_message(LARGE_MESSAGE)
+            self.assertEqual(await asyncio.wait_for(received.get(), 10), (b'\x00hello\xff', (client.ip, client.port)))
+            self.assertEqual(await asyncio.wait_for(received.get(), 10), (LARGE_MESSAGE, (client.ip, client.port)))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for peer in peers:
+                if peer.stream.server is not None:
+                    peer.stream.server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import struct
+import unittest
+
+from src.Packet import PacketFactory
+from src.Type import Type
+from src.Wire import Wire
+from src.tools.FrameDecoder import FrameDecoder
+
+ADDRESS = ('127.000.000.001', 5000)
+
+
+def frame(type, body_size, version=0):
+    """
+    A v1 frame of the type with a body of 'body_size' bytes.
+    """
+    buf = bytearray(Wire.header_size + body_size)
+    struct.pack_into(">hhi", buf, 0, version, int(type), len(buf))
+    buf[Wire.header_size:] = bytes(i % 251 for i in range(body_size))
+    return bytes(buf)
+
+
+def decode_in_chunks(decoder, data, size):
+    frames = []
+    for offset in range(0, len(data), size):
+        frames.extend(decoder.decode(data[offset:offset + size]))
+    return [bytes(frame) for frame in frames]
+
+
+class TestFrameDecoder(unittest.TestCase):
+    def test_frames_split_across_chunks(self):
+        frames = [frame(Type.message, size) for size in (0, 1, 7, 100, 3000)]
+        data = b''.join(frames)
+        for size in (1, 3, 8, 21, 1000, len(data)):
+            self.assertEqual(decode_in_chunks(FrameDecoder(), data, size), frames)
+        self.assertEqual(FrameDecoder().decode(data[:-1]), frames[:-1])
+
+    def test_feed_then_frames(self):
+        frames = [frame(Type.join, 5), frame(Type.message, 50)]
+        decoder = FrameDecoder()
+        decoder.feed(b''.join(frames)[:30])
+        self.assertEqual(decoder.frames(), [frames[0]])
+        self.assertEqual(decoder.pending(), 5)
+        decoder.feed(b''.join(frames)[30:])
+        self.assertEqual([bytes(f) for f in decoder.frames()], [frames[1]])
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_oversized_frame_is_skipped(self):
+        small = frame(Type.join, 10)
+        data = small + frame(Type.fragment, 200) + small
+        for size in (1, 16, 64, len(data)):
+            self.assertEqual(decode_in_chunks(FrameDecoder(max_frame_size=100), data, size), [small, small])
+
+    def test_messages_may_be_larger_than_max_frame_size(self):
+        message = frame(Type.message, 200)
+        small = frame(Type.join, 10)
+        decoder = FrameDecoder(max_frame_size=100, max_message_frame_size=300)
+        self.assertEqual(decode_in_chunks(decoder, message + small, 64), [message, small])
+        self.assertEqual(decode_in_chunks(FrameDecoder(max_frame_size=100), message + small, 64), [small])
+        self.assertEqual(decode_in_chunks(decoder, frame(Type.fragment, 200) + small, 64), [small])
+
+    def test_invalid_length_discards_the_buffer(self):
+        small = frame(Type.join, 10)
+        bad = bytearray(small)
+        struct.pack_into(">i", bad, 4, 3)
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.decode(small + bytes(bad)), [small])
+        self.assertEqual(decoder.pending(), 0)
+
+
+class TestBatch(unittest.TestCase):
+    def packets(self, version):
+        factory = PacketFactory(version, source_address=ADDRESS)
+        packets = [factory.new_message_packet(b'message %d' % i, ADDRESS) for i in range(20)]
+        packets.append(factory.new_message_packet(b'x' * (2 * FrameDecoder.batch_entry_size), ADDRESS))
+        packets.append(factory.new_join_packet(('127.000.000.002', 6000)))
+        packets.extend(factory.new_message_packet(b'tail %d' % i, ADDRESS) for i in range(3))
+        return [bytes(packet.get_buf()) for packet in packets]
+
+    def test_round_trip(self):
+        for version in (0, 2):
+            packets = self.packets(version)
+            counts = []
+            batched = FrameDecoder.batch(packets, counts)
+            # The runs before and after the large packet and the one from another source.
+            self.assertEqual([FrameDecoder.get_type(f) for f in batched],
+                             [Type.batch, Type.message, Type.join, Type.batch])
+            self.assertEqual(counts, [20, 1, 1, 3])
+            data = b''.join(bytes(f) for f in batched)
+            self.assertEqual(decode_in_chunks(FrameDecoder(), data, 100), packets)
+
+    def test_batch_size_is_bounded(self):
+        factory = PacketFactory(source_address=ADDRESS)
+        packets = [bytes(factory.new_message_packet(b'y' * 1000, ADDRESS).get_buf()) for _ in range(200)]
+        batched = FrameDecoder.batch(packets)
+        self.assertGreater(len(batched), 1)
+        self.assertTrue(all(len(f) <= FrameDecoder.batch_size for f in batched))
+        self.assertEqual(FrameDecoder().decode(b''.join(bytes(f) for f in batched)), packets)
+
+    def test_single_frames_are_not_batched(self):
+        packets = self.packets(0)[:1]
+        self.assertEqual(FrameDecoder.batch(packets), packets)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import random
+import threading
+import unittest
+
+from src.tools.NetworkGraph import NetworkGraph, GraphNode
+
+IP = '127.000.000.001'
+
+
+def build_graph(size, capacity=2, seed=0):
+    """
+    A NetworkGraph of 'size' nodes besides the root, each joined where find_parent_and_assign puts it.
+    """
+    graph = NetworkGraph(GraphNode((IP, 10000), capacity), default_capacity=capacity)
+    rng = random.Random(seed)
+    for port in range(10001, 10001 + size):
+        graph.register_node(IP, port, rng.choice([None, 1, 3]))
+        graph.find_parent_and_assign(IP, port)
+    return graph
+
+
+def in_subtree(node, subtree_root):
+    while node is not None:
+        if node is subtree_root:
+            return True
+        node = node.parent
+    return False
+
+
+class TestFindParent(unittest.TestCase):
+    def test_never_inside_the_sender_subtree(self):
+        for seed in range(5):
+            graph = build_graph(60, seed=seed)
+            rng = random.Random(seed)
+            for _ in range(40):
+                sender = rng.choice(graph.nodes[1:])
+                candidates = [node for node in graph.nodes
+                              if node.is_available() and node.depth() >= 0 and node is not sender.parent and
+                              not in_subtree(node, sender)]
+                parent = graph.find_parent(sender.get_address())
+                if not candidates:
+                    self.assertIsNone(parent)
+                    continue
+                self.assertFalse(in_subtree(parent, sender))
+                self.assertIsNot(parent, sender.parent)
+                self.assertEqual(parent.depth(), min(node.depth() for node in candidates))
+                graph.assign_parent(sender.ip, sender.port, parent.get_address())
+
+    def test_unknown_sender(self):
+        graph = build_graph(3)
+        self.assertIsNone(graph.find_parent((IP, 20000)))
+
+
+class TestRemoveNode(unittest.TestCase):
+    def check_invariants(self, graph):
+        attached = [graph.root] + list(graph.root.iter_subtree())
+        for node in attached:
+            self.assertEqual(node.subtree_size, 1 + sum(child.subtree_size for child in node.children))
+            self.assertLessEqual(len(node.children), node.capacity)
+            for child in node.children:
+                self.assertIs(child.parent, node)
+                self.assertEqual(child.depth(), node.depth() + 1)
+        for node in graph.nodes:
+            if node not in attached:
+                self.assertEqual(node.depth(), -1)
+        self.assertEqual(graph.root.subtree_size, len(attached))
+
+    def test_reattach_children_keeps_depths_and_subtree_sizes(self):
+        for seed in range(5):
+            graph = build_graph(80, seed=seed)
+            rng = random.Random(seed)
+            for _ in range(20):
+                attached = list(graph.root.iter_subtree())
+                if not attached:
+                    break
+                node = rng.choice(attached)
+                sizes = {child: child.subtree_size for child in node.children}
+                size = graph.root.subtree_size
+                reattached = graph.remove_node(node.get_address(), reattach_children=True)
+                self.assertIsNone(node.parent)
+                self.assertFalse(node.alive)
+                for child, parent in reattached:
+                    self.assertIs(child.parent, parent)
+                    self.assertTrue(child.alive)
+                # Only the node and the sub-trees which found no new parent are gone.
+                lost = sum(sizes[child] for child in sizes if child not in dict(reattached))
+                self.assertEqual(graph.root.subtree_size, size - 1 - lost)
+                self.check_invariants(graph)
+
+    def test_children_die_without_reattach(self):
+        graph = build_graph(20, capacity=2)
+        node = graph.root.children[0]
+        subtree = list(node.iter_subtree())
+        self.assertEqual(graph.remove_node(node.get_address()), [])
+        self.assertTrue(all(not child.alive for child in subtree))
+        self.check_invariants(graph)
+
+    def test_listener_gets_every_reattached_child(self):
+        graph = build_graph(30, capacity=2)
+        calls = []
+        graph.reattach_listener = lambda child, parent: calls.append((child, parent))
+        node = graph.root.children[0]
+        reattached = graph.remove_node(node.get_address(), reattach_children=True)
+        self.assertEqual(calls, reattached)
+        self.check_invariants(graph)
+
+    def test_listener_runs_with_the_graph_unlocked(self):
+        graph = build_graph(30, capacity=2)
+        node = graph.root.children[0]
+        node.expiration_time = lambda: -1
+        graph.update_latest_reunion_time(node.get_address())
+        locked = []
+
+        def listener(child, parent):
+            # Another thread can use the graph while the listener waits.
+            reader = threading.Thread(target=graph.get_subtree_parents, args=(child.get_address(),))
+            reader.start()
+            reader.join(1)
+            locked.append(reader.is_alive())
+
+        graph.reattach_listener = listener
+        graph.remove_all_expired_nodes()
+        self.assertFalse(node.alive)
+        self.assertEqual(locked, [False] * len(locked))
+        self.assertTrue(locked)
+        self.check_invariants(graph)
+
+
+if __name__ == '__main__':
+    unittest.main()
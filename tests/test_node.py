@@ -0,0 +1,89 @@
+import unittest
+
+from src.Packet import PacketFactory
+from src.Type import Type
+from src.tools.FrameDecoder import FrameDecoder
+from src.tools.Node import Node
+from src.tools.OutBuffLimits import OutBuffLimits
+
+
+class StalledSocket:
+    """
+    Stands in for the ClientSocket of a neighbour that reads nothing, or only 'accepted' bytes.
+    """
+
+    def __init__(self, accepted=0):
+        self.accepted = accepted
+        self.written = bytearray()
+
+    def sendmsg_nowait(self, parts):
+        data = b''.join(bytes(part) for part in parts)[:self.accepted]
+        self.accepted -= len(data)
+        self.written += data
+        return len(data)
+
+
+class UnconnectedNode(Node):
+    def connect(self):
+        self.socket = StalledSocket()
+
+
+class TestBatchingNodeLimits(unittest.TestCase):
+    address = ('127.0.0.1', 31000)
+
+    def setUp(self):
+        self.factory = PacketFactory(source_address=self.address)
+        self.node = UnconnectedNode(self.address)
+        self.node.accepts_batches = True
+        self.node.limits = OutBuffLimits(max_packets=10)
+
+    def message(self, i):
+        return self.factory.new_message_packet(b'message %d' % i, self.address).get_buf()
+
+    def test_drop_oldest_after_a_stalled_write(self):
+        for i in range(10):
+            self.assertTrue(self.node.add_message_to_out_buff(self.message(i)))
+        self.assertFalse(self.node.send_message())
+        # The messages were not packed into a Batch in out_buff, so the oldest of them can still make room.
+        for i in range(10, 15):
+            self.assertTrue(self.node.add_message_to_out_buff(self.message(i)))
+        self.assertEqual(self.node.dropped_packets, 5)
+        self.assertEqual(self.node.get_out_buff_size(), (sum(len(self.message(i)) for i in range(5, 15)), 10))
+
+    def test_never_drop_is_kept_while_dropping_oldest(self):
+        advertise = self.factory.new_advertise_packet('REQ', self.address).get_buf()
+        self.node.add_message_to_out_buff(advertise)
+        for i in range(12):
+            self.assertTrue(self.node.add_message_to_out_buff(self.message(i)))
+        self.assertIs(self.node.out_buff[0], advertise)
+        self.assertEqual(self.node.get_out_buff_size()[1], 10)
+
+    def test_partial_batch_is_written_in_order(self):
+        messages = [self.message(i) for i in range(10)]
+        for message in messages:
+            self.node.add_message_to_out_buff(message)
+        self.node.socket.accepted = 50
+        self.assertFalse(self.node.send_message())
+        # The rest of the Batch stays at the head; The messages it carries no longer count on their own.
+        self.assertTrue(self.node.partial_head)
+        batch = FrameDecoder.batch(messages)
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(self.node.get_out_buff_size(), (len(batch[0]) - 50, 1))
+        self.node.add_message_to_out_buff(self.message(10))
+        self.node.socket.accepted = 1 << 20
+        self.assertTrue(self.node.send_message())
+        self.assertEqual(self.node.get_out_buff_size(), (0, 0))
+        frames = FrameDecoder().decode(self.node.socket.written)
+        self.assertEqual([bytes(frame) for frame in frames], [bytes(m) for m in messages + [self.message(10)]])
+
+    def test_take_out_buff_packs_batches(self):
+        for i in range(5):
+            self.node.add_message_to_out_buff(self.message(i))
+        taken = self.node.take_out_buff()
+        self.assertEqual(len(taken), 1)
+        self.assertEqual(FrameDecoder.get_type(taken[0]), Type.batch)
+        self.assertEqual(self.node.get_out_buff_size(), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import threading
+import time
+import unittest
+
+from src.Packet import PacketFactory
+from src.Type import Type
+from src.tools.OutBuffLimits import OutBuffLimits, QueuePolicy
+from tests.test_node import UnconnectedNode
+
+ADDRESS = ('127.000.000.001', 5000)
+
+
+class TestOutBuffLimits(unittest.TestCase):
+    def test_policies(self):
+        limits = OutBuffLimits(policies={Type.message: QueuePolicy.block}, default_policy=QueuePolicy.never_drop)
+        self.assertEqual(limits.get_policy(Type.message), QueuePolicy.block)
+        self.assertEqual(limits.get_policy(Type.fragment), QueuePolicy.drop_new)
+        self.assertEqual(limits.get_policy(Type.advertise), QueuePolicy.never_drop)
+        self.assertEqual(limits.get_policy(Type.batch), QueuePolicy.never_drop)
+        # The defaults are not changed by the policies of one object.
+        self.assertEqual(OutBuffLimits().get_policy(Type.message), QueuePolicy.drop_oldest)
+
+    def test_fits_and_above(self):
+        limits = OutBuffLimits(max_bytes=100, max_packets=10)
+        self.assertTrue(limits.fits(100, 10))
+        self.assertFalse(limits.fits(101, 1))
+        self.assertFalse(limits.fits(1, 11))
+        self.assertTrue(limits.above(0.8, 81, 1))
+        self.assertTrue(limits.above(0.8, 1, 9))
+        self.assertFalse(limits.above(0.8, 80, 8))
+        self.assertTrue(OutBuffLimits().fits(1 << 40, 1 << 20))
+        self.assertFalse(OutBuffLimits().above(0.5, 1 << 40, 1 << 20))
+
+
+class TestQueuePolicies(unittest.TestCase):
+    def setUp(self):
+        self.factory = PacketFactory(source_address=ADDRESS)
+        self.node = UnconnectedNode(ADDRESS)
+
+    def message(self, i):
+        return self.factory.new_message_packet(b'message %d' % i, ADDRESS).get_buf()
+
+    def fragment(self, i):
+        return self.factory.new_fragment_packet(ADDRESS, 1, i, 100, b'f', ADDRESS).get_buf()
+
+    def advertise(self):
+        return self.factory.new_advertise_packet('REQ', ADDRESS).get_buf()
+
+    def test_drop_new(self):
+        self.node.limits = OutBuffLimits(max_packets=3)
+        for i in range(3):
+            self.assertTrue(self.node.add_message_to_out_buff(self.fragment(i)))
+        self.assertFalse(self.node.add_message_to_out_buff(self.fragment(3)))
+        self.assertEqual(self.node.dropped_packets, 1)
+        self.assertEqual(list(self.node.out_buff), [self.fragment(i) for i in range(3)])
+
+    def test_drop_oldest(self):
+        self.node.limits = OutBuffLimits(max_packets=3)
+        for i in range(5):
+            self.assertTrue(self.node.add_message_to_out_buff(self.message(i)))
+        self.assertEqual(self.node.dropped_packets, 2)
+        self.assertEqual(list(self.node.out_buff), [self.message(i) for i in range(2, 5)])
+
+    def test_drop_oldest_can_not_drop_other_types(self):
+        self.node.limits = OutBuffLimits(max_packets=2)
+        self.node.add_message_to_out_buff(self.advertise())
+        self.node.add_message_to_out_buff(self.fragment(0))
+        self.assertFalse(self.node.add_message_to_out_buff(self.message(0)))
+        self.assertEqual(self.node.get_out_buff_size()[1], 2)
+
+    def test_never_drop(self):
+        self.node.limits = OutBuffLimits(max_packets=1)
+        for _ in range(3):
+            self.assertTrue(self.node.add_message_to_out_buff(self.advertise()))
+        self.assertEqual(self.node.get_out_buff_size()[1], 3)
+        self.assertEqual(self.node.dropped_packets, 0)
+
+    def test_oversized_message_fits_an_empty_out_buff(self):
+        self.node.limits = OutBuffLimits(max_bytes=10, policies={Type.message: QueuePolicy.drop_new})
+        self.assertTrue(self.node.add_message_to_out_buff(self.message(0)))
+        self.assertFalse(self.node.add_message_to_out_buff(self.message(1)))
+
+    def test_block_times_out(self):
+        self.node.limits = OutBuffLimits(max_packets=1, policies={Type.message: QueuePolicy.block},
+                                         block_timeout=0.05)
+        self.node.add_message_to_out_buff(self.message(0))
+        self.assertFalse(self.node.add_message_to_out_buff(self.message(1), may_block=True))
+        # The thread which flushes the out buffers never waits.
+        self.assertFalse(self.node.add_message_to_out_buff(self.message(1)))
+        self.assertEqual(self.node.dropped_packets, 2)
+
+    def test_block_waits_for_room(self):
+        self.node.limits = OutBuffLimits(max_packets=1, policies={Type.message: QueuePolicy.block},
+                                         block_timeout=5)
+        self.node.add_message_to_out_buff(self.message(0))
+
+        def flush():
+            time.sleep(0.05)
+            self.node.socket.accepted = 1 << 20
+            self.node.send_message()
+
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+        self.assertTrue(self.node.add_message_to_out_buff(self.message(1), may_block=True))
+        flusher.join()
+        self.assertEqual(list(self.node.out_buff), [self.message(1)])
+
+    def test_watermarks(self):
+        crossings = []
+        self.node.limits = OutBuffLimits(max_packets=10)
+        self.node.watermark_listener = lambda node, above: crossings.append((above, node.get_out_buff_size()[1]))
+        for i in range(9):
+            self.node.add_message_to_out_buff(self.message(i))
+        self.assertEqual(crossings, [(True, 9)])
+        self.node.socket.accepted = 1 << 20
+        self.node.send_message()
+        self.assertEqual(crossings, [(True, 9), (False, 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
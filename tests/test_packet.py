@@ -0,0 +1,153 @@
+import unittest
+import zlib
+
+from src.Packet import Packet, PacketFactory
+from src.Type import Type
+from src.tools.FrameDecoder import FrameDecoder
+
+ADDRESS = ('127.000.000.001', 5000)
+NEIGHBOUR = ('127.000.000.002', 6000)
+
+
+def arrived(packet):
+    # The packet as a receiver decodes it from the wire.
+    return Packet(buf=bytes(packet.get_buf()))
+
+
+class TestMessagePayload(unittest.TestCase):
+    def test_binary_payloads(self):
+        factory = PacketFactory(source_address=ADDRESS)
+        payload = b'\x00binary\xff'
+        for message in (payload, bytearray(payload), memoryview(payload)):
+            packet = arrived(factory.new_message_packet(message, ADDRESS))
+            self.assertEqual(packet.get_type(), Type.message)
+            self.assertEqual(packet.get_length(), packet.get_header_size() + len(payload))
+            self.assertEqual(packet.get_source_server_address(), ADDRESS)
+            self.assertIsInstance(packet.get_payload(), memoryview)
+            self.assertEqual(bytes(packet.get_payload()), payload)
+
+    def test_text_is_decoded_on_request(self):
+        factory = PacketFactory(source_address=ADDRESS)
+        packet = arrived(factory.new_message_packet('hello é', ADDRESS))
+        self.assertEqual(bytes(packet.get_payload()), 'hello é'.encode('utf-8'))
+        self.assertEqual(packet.get_body(), 'hello é')
+
+
+class TestPacketVersions(unittest.TestCase):
+    versions = (0, Packet.compact_version)
+
+    def test_message(self):
+        for version in self.versions:
+            factory = PacketFactory(version, source_address=ADDRESS)
+            packet = arrived(factory.new_message_packet(b'\x00binary\xff', ADDRESS))
+            self.assertEqual(packet.get_version(), version)
+            self.assertEqual(packet.get_type(), Type.message)
+            self.assertEqual(packet.get_header_size(), 14 if version == Packet.compact_version else 20)
+            self.assertEqual(packet.get_length(), packet.get_header_size() + 8)
+            self.assertEqual(packet.get_source_server_address(), ADDRESS)
+            self.assertEqual(bytes(packet.get_payload()), b'\x00binary\xff')
+
+    def test_advertise(self):
+        for version in self.versions:
+            factory = PacketFactory(version, source_address=ADDRESS)
+            packet = arrived(factory.new_advertise_packet("RES", ADDRESS, NEIGHBOUR, 3))
+            self.assertEqual(packet.get_subtype(), "RES")
+            self.assertEqual(packet.get_body_address(), NEIGHBOUR)
+            self.assertEqual(packet.get_body_option(), 3)
+
+    def test_fragments(self):
+        for version in self.versions:
+            factory = PacketFactory(version, source_address=ADDRESS)
+            message = bytes(range(256)) * 4
+            fragments = [arrived(packet) for packet in factory.new_fragment_packets(message, ADDRESS, 7, 300)]
+            self.assertEqual([packet.get_fragment_info() for packet in fragments],
+                             [(ADDRESS, 7, offset, len(message)) for offset in (0, 300, 600, 900)])
+            self.assertEqual(b''.join(bytes(packet.get_fragment_data()) for packet in fragments), message)
+
+    def test_register(self):
+        for version in self.versions:
+            factory = PacketFactory(version, source_address=ADDRESS)
+            request = arrived(factory.new_register_packet("REQ", ADDRESS, NEIGHBOUR, 5))
+            self.assertEqual(request.get_body_address(), NEIGHBOUR)
+            self.assertEqual(request.get_body_option(), 5)
+            self.assertFalse(request.is_register_ack())
+            response = arrived(factory.new_register_packet("RES", ADDRESS))
+            self.assertEqual(response.get_subtype(), "RES")
+            self.assertTrue(response.is_register_ack())
+
+    def test_reunion_entries(self):
+        for version in self.versions:
+            factory = PacketFactory(version, source_address=ADDRESS)
+            packet = Packet(buf=bytearray(factory.new_reunion_packet("REQ", ADDRESS, [ADDRESS]).get_buf()))
+            packet.append_reunion_entry(NEIGHBOUR)
+            self.assertEqual(packet.get_reunion_entry_count(), 2)
+            self.assertEqual(packet.get_reunion_entries(), [ADDRESS, NEIGHBOUR])
+            self.assertEqual(packet.pop_reunion_entry(), NEIGHBOUR)
+            self.assertEqual(arrived(packet).get_reunion_entries(), [ADDRESS])
+
+
+class TestPacketCompression(unittest.TestCase):
+    versions = (0, Packet.compact_version)
+
+    def test_round_trip(self):
+        for version in self.versions:
+            factory = PacketFactory(version, source_address=ADDRESS, capabilities=Packet.accepts_compression_flag)
+            packet = factory.new_message_packet(b'hello ' * 500, ADDRESS)
+            compressed = packet.compress(64)
+            self.assertTrue(compressed.is_compressed())
+            self.assertLess(len(compressed.get_buf()), len(packet.get_buf()))
+            received = arrived(compressed)
+            self.assertTrue(received.is_compressed())
+            self.assertTrue(received.accepts_compression())
+            self.assertEqual(received.get_length(), packet.get_length())
+            self.assertEqual(received.get_source_server_address(), ADDRESS)
+            self.assertEqual(bytes(received.get_payload()), b'hello ' * 500)
+            plain = received.decompressed()
+            self.assertFalse(plain.is_compressed())
+            self.assertEqual(bytes(plain.get_buf()), bytes(packet.get_buf()))
+
+    def test_source_edited_after_compress(self):
+        for version in self.versions:
+            factory = PacketFactory(version, source_address=ADDRESS, capabilities=Packet.accepts_compression_flag)
+            entries = [ADDRESS] * 40
+            packet = Packet(buf=bytearray(factory.new_reunion_packet("REQ", ADDRESS, entries).get_buf()))
+            compressed = packet.compress(16)
+            packet.append_reunion_entry(NEIGHBOUR)
+            packet.set_subtype("RES")
+            self.assertEqual(compressed.get_subtype(), "REQ")
+            self.assertEqual(compressed.get_reunion_entries(), entries)
+            self.assertEqual(arrived(compressed).get_reunion_entries(), entries)
+            self.assertEqual(packet.get_reunion_entries(), entries + [NEIGHBOUR])
+
+    def test_not_compressed(self):
+        for version in self.versions:
+            factory = PacketFactory(version, source_address=ADDRESS)
+            self.assertIsNone(factory.new_message_packet(b'short', ADDRESS).compress(64))
+            self.assertIsNone(factory.new_message_packet(bytes(range(256)), ADDRESS).compress(64))
+            packet = factory.new_message_packet(b'plain', ADDRESS)
+            self.assertFalse(arrived(packet).is_compressed())
+            self.assertIs(packet.decompressed(), packet)
+
+    def compressed_packet(self, body):
+        factory = PacketFactory(source_address=ADDRESS)
+        header = bytearray(factory.new_message_packet(b'', ADDRESS).get_buf())
+        header[:2] = (Packet.compressed_flag).to_bytes(2, 'big')
+        buf = header + body
+        buf[4:8] = len(buf).to_bytes(4, 'big')
+        return Packet(buf=buf)
+
+    def test_decompression_is_bounded(self):
+        bomb = self.compressed_packet(zlib.compress(bytes(4 * FrameDecoder.max_frame_size)))
+        self.assertTrue(bomb.is_compressed())
+        with self.assertRaises(ValueError):
+            bomb.get_length()
+
+    def test_invalid_compressed_bodies(self):
+        body = zlib.compress(b'hello ' * 100)
+        for invalid in (body[:-4], body + b'trailing', b'not zlib at all'):
+            with self.assertRaises(ValueError):
+                self.compressed_packet(invalid).get_payload()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import queue
+import socket
+import threading
+import time
+import unittest
+
+from src.Packet import Packet
+from src.Peer import Peer
+
+IP = '127.0.0.1'
+# Long enough to be sent as Fragments.
+LARGE_MESSAGE = bytes(range(256)) * 400
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((IP, 0))
+        return s.getsockname()[1]
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class TestPeerOptions(unittest.TestCase):
+    def test_invalid_capacity(self):
+        for capacity in (0, -1, Packet.max_capacity + 1):
+            with self.assertRaises(ValueError):
+                Peer('127.0.0.1', 5000, capacity=capacity)
+
+
+class TestPeerLoopback(unittest.TestCase):
+    def test_messages_between_two_peers(self):
+        root_port = free_port()
+        root = Peer(IP, root_port, is_root=True, flush_delay=0.01)
+        client = Peer(IP, free_port(), root_address=(IP, root_port), flush_delay=0.01)
+        received = queue.Queue()
+        root.message_listener = lambda payload, sender: received.put((bytes(payload), sender))
+        for peer in (root, client):
+            threading.Thread(target=peer.run, daemon=True).start()
+        client.register()
+        client.advertise()
+        self.assertTrue(wait_until(lambda: client.is_alive))
+        client.send_message(b'\x00hello\xff')
+        client.send_message(LARGE_MESSAGE)
+        self.assertEqual(received.get(timeout=10), (b'\x00hello\xff', (client.ip, client.port)))
+        self.assertEqual(received.get(timeout=10), (LARGE_MESSAGE, (client.ip, client.port)))
+
+
+if __name__ == '__main__':
+    unittest.main()